@@ -0,0 +1,252 @@
+"""
+Benchmarks of the check execution and submission hot paths, results (best of several repeats, normalized
+per operation) are compared to the stored baseline and the run fails if any benchmark got slower than
+baseline * tolerance.
+
+    python benchmarks/run.py                  # compare to benchmarks/baseline.json
+    python benchmarks/run.py --save           # record new baseline
+    python benchmarks/run.py -k livestatus    # run selected benchmarks only
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import nap  # noqa: E402
+import nap.core  # noqa: E402
+import nap.livestatus  # noqa: E402
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+_now = getattr(time, 'perf_counter', time.time)
+benchmarks = list()
+
+
+def benchmark(unit, ops):
+    # registers benchmark taking a temporary directory, it runs ops operations per call; benchmarks
+    # returning a number report their own elapsed time (seconds) instead of the wall time of the call
+    def decorator(f):
+        benchmarks.append((f.__name__, f, unit, ops))
+        return f
+    return decorator
+
+
+class _Streams(object):
+    # PluginIO redirects sys.stdout/sys.stderr on its own, restored afterwards
+    def __enter__(self):
+        self.saved = sys.stdout, sys.stderr
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        sys.stdout, sys.stderr = self.saved
+
+
+@benchmark('us/import', 1)
+def import_nap_core(tmp_dir):
+    # cumulative import time of nap.core in a fresh interpreter (-X importtime), tests/test_startup.py
+    # keeps it within tolerance of the baseline
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    p = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', 'import nap.core'], stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, cwd=ROOT, env=env)
+    _, err = p.communicate()
+    for line in err.decode().splitlines():
+        fields = [f.strip() for f in line.split('|')]
+        if len(fields) == 3 and fields[2] == 'nap.core':
+            return int(fields[1]) / 1e6
+    raise RuntimeError("nap.core import time not reported: %s" % err.decode())
+
+
+@benchmark('us/metric', 200)
+def plugin_run(tmp_dir):
+    app = nap.core.Plugin()
+    for i in range(200):
+        def m(args, io):
+            print("output")
+            io.add_perf_data("value", 1)
+            io.set_status(nap.OK, "ok")
+        app.metric(metric_name='m%d' % i)(m)
+    with _Streams():
+        app.execute(['--dry-run'], stdout=StringIO())
+
+
+@benchmark('us/metric', 200)
+def plugin_run_passive(tmp_dir):
+    app = nap.core.Plugin()
+    for i in range(200):
+        def m(args, io):
+            io.set_status(nap.OK, "ok")
+        app.metric(metric_name='m%d' % i, passive=True)(m)
+
+    @app.metric()
+    def active(args, io):
+        io.set_status(nap.OK, "ok")
+
+    with _Streams():
+        app.execute(['--dry-run'], stdout=StringIO())
+
+
+@benchmark('ms/format', 1)
+def plugin_io_format(tmp_dir):
+    with _Streams():
+        stream = StringIO()
+        io = nap.core.PluginIO("metric", "localhost", command_pipe=os.devnull, dry_run=True, stdout=stream)
+        io.add_perf_data_many(['label%d' % i for i in range(5000)], range(5000), uom='ms', warn=10, crit=20)
+        line = "detailed | output line\n" * 4
+        for _ in range(10000):
+            io.write(line)
+        io.set_status(nap.OK, "summary")
+        io.plugin_output('nagios')
+        io.plugin_output('passive')
+        io.close()
+
+
+@benchmark('us/command', 200)
+def sub_process_popen(tmp_dir):
+    for i in range(200):
+        nap.core.sub_process("echo %d" % i, shell=True)
+
+
+@benchmark('us/command', 200)
+def sub_process_session(tmp_dir):
+    import nap.session
+    with nap.session.SessionPool() as pool:
+        for i in range(200):
+            nap.core.sub_process("echo %d" % i, mode='session', session=pool)
+
+
+@benchmark('us/command', 20000)
+def passive_submission(tmp_dir):
+    fifo = os.path.join(tmp_dir, 'nagios.cmd')
+    os.mkfifo(fifo)
+    received = list()
+
+    def reader():
+        with open(fifo, 'rb') as f:
+            received.append(sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(65536), b'')))
+
+    t = threading.Thread(target=reader)
+    t.start()
+    with nap.core.CommandPipe(fifo) as cmd_pipe:
+        for i in range(20000):
+            cmd_pipe.write("[%d] PROCESS_SERVICE_CHECK_RESULT;host%d;metric;0;OK - summary | value=%d;;;;\\n"
+                           "details\\n" % (i, i % 100, i))
+    t.join()
+    assert received == [20000], received
+
+
+@benchmark('us/row', 50000)
+def livestatus_query(tmp_dir):
+    from tests.test_livestatus import FakeLivestatus
+    path = os.path.join(tmp_dir, 'live')
+    server = FakeLivestatus(path, [['host_name', 'description', 'state', 'perf_data']] +
+                            [['host%d' % (i % 100), 'service%d' % i, i % 4, 'value=%d;;;;' % i]
+                             for i in range(25000)])
+    try:
+        with nap.livestatus.LivestatusClient(path) as client:
+            assert len(client.query("GET services")) == 25000
+            assert sum(1 for _ in client.iter_query("GET services")) == 25000
+    finally:
+        server.close()
+
+
+@benchmark('us/event', 2000)
+def dq_enqueue(tmp_dir):
+    import nap.dq
+    writer = nap.dq.QueueWriter(tmp_dir, '/topic/benchmark')
+    writer.enqueue_many(({'host': 'host%d' % i, 'metric': 'm', 'status': 0} for i in range(2000)), batch_size=500)
+
+
+def _available(name):
+    if name == 'import_nap_core':
+        return sys.version_info >= (3, 7)
+    if name == 'dq_enqueue':
+        try:
+            import messaging  # noqa: F401
+        except ImportError:
+            return False
+    return True
+
+
+def measure(f, unit, ops, repeat):
+    scale = {'ms': 1e3, 'us': 1e6}[unit.split('/')[0]]
+    timings = list()
+    for _ in range(repeat):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            start = _now()
+            elapsed = f(tmp_dir)
+            timings.append(_now() - start if elapsed is None else elapsed)
+        finally:
+            shutil.rmtree(tmp_dir)
+    return min(timings) * scale / ops
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of python-nap hot paths")
+    parser.add_argument('-k', dest='select', help='Run only benchmarks containing this string')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Repeats per benchmark (best is taken)')
+    parser.add_argument('--baseline', default=BASELINE, help='Baseline file (defaults to %(default)s)')
+    parser.add_argument('--save', action='store_true', help='Store results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=2.0,
+                        help='Fail if benchmark is slower than baseline times tolerance (defaults to 2.0)')
+    parser.add_argument('--json', help='Write results to this file')
+    args = parser.parse_args(argv)
+
+    baseline = dict()
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['benchmarks']
+
+    results = dict()
+    regressions = list()
+    for name, f, unit, ops in benchmarks:
+        if args.select and args.select not in name:
+            continue
+        if not _available(name):
+            print("%-20s skipped (dependencies not available)" % name)
+            continue
+        value = measure(f, unit, ops, args.repeat)
+        results[name] = {'value': round(value, 3), 'unit': unit}
+        line = "%-20s %10.3f %s" % (name, value, unit)
+        if name in baseline:
+            ratio = value / baseline[name]['value']
+            line += "  (baseline %.3f, x%.2f)" % (baseline[name]['value'], ratio)
+            if ratio > args.tolerance:
+                regressions.append(name)
+                line += "  REGRESSION"
+        print(line)
+
+    report = {'python': platform.python_version(), 'platform': platform.platform(), 'benchmarks': results}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.save:
+        if os.path.exists(args.baseline):
+            report['benchmarks'] = dict(baseline, **results)
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print("Baseline stored in %s" % args.baseline)
+        return 0
+    if regressions:
+        print("Performance regression in: %s" % ', '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import subprocess
+import sys
+import threading
+import traceback
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import nap
+import nap.core
+
+log = logging.getLogger()
+
+
+def _attach_child_watcher():
+    # before python 3.8, asyncio subprocesses are only reaped by the child watcher attached to the loop
+    # running them (can be attached from the main thread only)
+    if sys.version_info >= (3, 8) or threading.current_thread().name != 'MainThread':
+        return
+    loop = asyncio.get_event_loop()
+    watcher = asyncio.get_child_watcher()
+    if getattr(watcher, '_loop', None) is not loop:
+        watcher.attach_loop(loop)
+
+
+@types.coroutine
+def _task_locals(coro):
+    # without context variables (python 3.6) nap.core._LocalVar values are shared by all tasks of the
+    # loop thread, values of the task (inherited when created) are swapped in for each step of coro
+    values = dict((var, var.get()) for var in nap.core._local_vars)
+    value, exc = None, None
+    while True:
+        saved = [(var, var.get()) for var in values]
+        for var, v in values.items():
+            var.set(v)
+        try:
+            if exc is None:
+                future = coro.send(value)
+            else:
+                future = coro.throw(exc)
+        except StopIteration as e:
+            return e.value
+        finally:
+            for var, v in saved:
+                values[var] = var.get()
+                var.set(v)
+        try:
+            value, exc = (yield future), None
+        except BaseException as e:
+            value, exc = None, e
+
+
+# asyncio counterpart of nap.core.sub_process (popen mode), returns tuple (return code, output),
+# raises subprocess.TimeoutExpired after killing the child (and its process group) if it doesn't
+# finish within timeout
+async def sub_process(args, dry_run=False, timeout=3600, shell=False):
+    if dry_run:
+        log.info("subprocess call: %s" % args)
+        return 0, "success from dry-run"
+    deadline = nap.core._current_deadline.get()
+    if deadline:
+        timeout = deadline.clip(timeout)
+    _attach_child_watcher()
+    if shell:
+        proc = await asyncio.create_subprocess_shell(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                                     start_new_session=True)
+    else:
+        if isinstance(args, str):
+            args = [args]
+        proc = await asyncio.create_subprocess_exec(*args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                                    start_new_session=True)
+    if deadline:
+        deadline.add_process(proc.pid)
+    try:
+        str_out, _ = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        nap.core._kill_process_group(proc.pid)
+        str_out, _ = await proc.communicate()
+        raise subprocess.TimeoutExpired(args, timeout, output=str_out)
+    except BaseException:
+        nap.core._kill_process_group(proc.pid)
+        raise
+    finally:
+        if deadline:
+            deadline.remove_process(proc.pid)
+    return proc.returncode, str_out
+
+
+async def _call_async_metric(plugin, entry, plugin_io):
+    # same as Plugin._call_metric, but without waiting for other runs computing the same result
+    # (which would block the event loop)
+    cache_ttl = entry[3].get('cache_ttl') if len(entry) > 3 else None
+    if not cache_ttl:
+        return await entry[0](plugin._entry_args(entry), plugin_io)
+    cache = plugin._result_cache()
+    key = plugin._cache_key(entry)
+    data = cache.get(key, cache_ttl)
+    if data is not None:
+        log.debug("   Replaying cached result of %s" % str(entry[0].__name__))
+        plugin_io._load_result(data)
+        return
+    await entry[0](plugin._entry_args(entry), plugin_io)
+    cache.set(key, plugin_io._dump_result())
+
+
+async def _run_async_metric(plugin, entry, deadline):
+    output = plugin._output_backend(entry)
+    plugin_io = plugin._plugin_io(entry)
+    plugin_function = entry[0]
+    exc = None
+    nap.core._current_deadline.set(deadline)
+    # CPU time of the event loop thread is shared by all coroutines, only wall time is recorded
+    usage = nap.core._Usage(thread_cpu=False)
+    try:
+        log.debug("   Coroutine call: %s" % str(plugin_function.__name__))
+        await _call_async_metric(plugin, entry, plugin_io)
+    except asyncio.CancelledError:
+        plugin_io.close()
+        raise
+    except Exception as e:
+        plugin_io.status = nap.UNKNOWN
+        plugin_io.summary = "Exception caught while executing plugin (%s)" % e
+        exc = traceback.format_exc()
+    stats = plugin._record_usage(entry, plugin_io, usage)
+    try:
+        if not deadline.complete():
+            return None
+        with nap.core._output_lock:
+            plugin_io.plugin_output(backend=output)
+            if exc:
+                sys.stdout.write(exc)
+    finally:
+        plugin_io.close()
+    result = nap.core.MetricResult(plugin_function.__name__, plugin_io.status, plugin_io.summary, output)
+    result.stats = stats
+    return result
+
+
+def _run_sync_metric(plugin, entry, deadline):
+    try:
+        return plugin._run_metric(entry, deadline, alarm=False)
+    finally:
+        nap.core._bound_stream.set(None)
+
+
+async def _schedule(plugin, deps, loop, executor, run_deadline):
+    # coroutine metrics run as tasks on the loop, other metrics in the executor;
+    # metrics are started once the metrics they depend on have finished and abandoned
+    # (cancelled, children killed) once their deadline passed
+    results = [None] * len(plugin.sequence)
+    pending = dict((k, set(v)) for k, v in deps.items())
+    tasks = dict()
+
+    def finished(idx):
+        for dep in pending.values():
+            dep.discard(idx)
+        plugin._results = [r for r in results if r]
+
+    def start_ready():
+        while any(not v for v in pending.values()):
+            for idx in sorted(k for k, v in pending.items() if not v):
+                del pending[idx]
+                entry = plugin.sequence[idx]
+                if run_deadline.expired():
+                    results[idx] = plugin._unfinished(entry, "timed out")
+                    finished(idx)
+                    continue
+                deadline = plugin._deadline(entry, run_deadline)
+                if nap.core._iscoroutinefunction(entry[0]):
+                    coro = _run_async_metric(plugin, entry, deadline)
+                    task = loop.create_task(coro if nap.core.contextvars else _task_locals(coro))
+                else:
+                    task = loop.run_in_executor(executor, _run_sync_metric, plugin, entry, deadline)
+                tasks[task] = (idx, deadline)
+
+    start_ready()
+    while tasks:
+        remaining = [d.remaining() for _, d in tasks.values() if d.expires is not None]
+        done, _ = await asyncio.wait(list(tasks.keys()), timeout=min(remaining) + 0.01 if remaining else None,
+                                     return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            idx, _ = tasks.pop(task)
+            result = task.result()
+            if result:
+                results[idx] = result
+            finished(idx)
+        for task, (idx, deadline) in list(tasks.items()):
+            if deadline.expired() and deadline.abandon():
+                deadline.kill()
+                task.cancel()
+                del tasks[task]
+                results[idx] = plugin._unfinished(plugin.sequence[idx], "timed out")
+                finished(idx)
+        start_ready()
+    plugin._results = results
+
+
+def run_metrics(plugin, deps, workers, run_deadline):
+    loop = asyncio.new_event_loop()
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        loop.run_until_complete(_schedule(plugin, deps, loop, executor, run_deadline))
+    finally:
+        executor.shutdown(wait=False)
+        loop.close()
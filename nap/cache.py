@@ -0,0 +1,212 @@
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import stat
+import tempfile
+import threading
+import time
+
+log = logging.getLogger()
+
+
+def default_directory():
+    # per-user cache directory (not world-writable like the temporary directory), nap-cache-<uid> in the
+    # temporary directory is used only if home isn't writable
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    if os.access(base, os.W_OK) or (not os.path.exists(base) and os.access(os.path.dirname(base), os.W_OK)):
+        return os.path.join(base, 'nap')
+    return os.path.join(tempfile.gettempdir(), 'nap-cache-%d' % os.getuid())
+
+
+def secure_directory(directory):
+    # creates directory (mode 0700) if it doesn't exist; directories other users could have created or
+    # can write to are refused, as anything cached (or spooled) there is replayed as if measured by the plugin
+    try:
+        os.makedirs(directory, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise OSError(errno.EPERM, "Refusing to use directory %s, it must be a directory (not a symlink) "
+                                   "owned by uid %d with mode 0700" % (directory, os.getuid()))
+    return directory
+
+
+class FileCache(object):
+    """
+    Cache of byte strings shared between processes, each entry is stored in its own file within
+    directory (replaced atomically on update), entries older than ttl seconds are considered stale
+    and the oldest entries are evicted once there is more than max_entries. Concurrent computation
+    of the same entry is serialized via its lock file (get_or_set), other entries are computed
+    independently.
+    """
+    def __init__(self, directory=None, ttl=60, max_entries=1024):
+        self.directory = secure_directory(directory or default_directory())
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    def _digest(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        return hashlib.sha1(key).hexdigest()
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest + '.entry')
+
+    def _lock_path(self, digest):
+        return os.path.join(self.directory, 'lock.' + digest)
+
+    def get(self, key, ttl=None):
+        path = self._path(self._digest(key))
+        ttl = self.ttl if ttl is None else ttl
+        try:
+            if time.time() - os.stat(path).st_mtime >= ttl:
+                return None
+            with open(path, 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def age(self, key):
+        # seconds since the entry was stored (None if there is no such entry)
+        try:
+            return time.time() - os.stat(self._path(self._digest(key))).st_mtime
+        except OSError:
+            return None
+
+    def set(self, key, data):
+        path = self._path(self._digest(key))
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        self._evict()
+
+    def delete(self, key):
+        try:
+            os.unlink(self._path(self._digest(key)))
+        except OSError:
+            pass
+
+    def _evict(self):
+        entries = list()
+        for name in os.listdir(self.directory):
+            if not name.endswith('.entry'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                entries.append((os.stat(path).st_mtime, path))
+            except OSError:
+                continue
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort()
+        for _, path in entries[:len(entries) - self.max_entries]:
+            # lock file goes with the entry (at worst a racing process computes the entry once more)
+            for p in (path, self._lock_path(os.path.basename(path)[:-len('.entry')])):
+                try:
+                    os.unlink(p)
+                except OSError:
+                    pass
+
+    def get_or_set(self, key, compute, ttl=None):
+        # returns cached entry, computing (and storing) it if stale; processes asking for the same
+        # stale entry wait for the first one to compute it
+        data = self.get(key, ttl)
+        if data is not None:
+            return data
+        with open(self._lock_path(self._digest(key)), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                data = self.get(key, ttl)
+                if data is not None:
+                    return data
+                data = compute()
+                self.set(key, data)
+                return data
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class SubmissionIndex(object):
+    """
+    Index of passive results last submitted per host and service (digest of status, summary and
+    performance data with the time of submission), shared between processes via a file within
+    directory. Unchanged results are skipped unless heartbeat seconds passed since they were last
+    submitted, so that freshness checks keep working. Results are recorded (submitted) only once the
+    writer reports they were written or spooled, so failed submissions are retried by the next run.
+    Index is read once, submissions are merged into it (under lock) on close and entries older than
+    heartbeat are dropped.
+    """
+    def __init__(self, directory=None, heartbeat=3600):
+        self.directory = secure_directory(directory or default_directory())
+        self.heartbeat = heartbeat
+        self.path = os.path.join(self.directory, 'submissions.json')
+        self._submitted = dict()
+        self._lock = threading.Lock()
+        self._index = self._read()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return dict()
+
+    def _entry(self, host, service, status, output):
+        # output is the summary line (with performance data) followed by escaped details, which are ignored
+        return '%s;%s' % (host, service or ''), self._digest('%d;%s' % (status, output.split('\\n', 1)[0]))
+
+    def should_submit(self, host, service, status, output):
+        key, digest = self._entry(host, service, status, output)
+        with self._lock:
+            last = self._submitted.get(key) or self._index.get(key)
+        return not (last and last[0] == digest and time.time() - last[1] < self.heartbeat)
+
+    def submitted(self, host, service, status, output):
+        # records result as submitted
+        key, digest = self._entry(host, service, status, output)
+        with self._lock:
+            self._submitted[key] = [digest, time.time()]
+
+    def _digest(self, value):
+        return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+    def close(self):
+        with self._lock:
+            submitted = self._submitted
+            self._submitted = dict()
+        if not submitted:
+            return
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                index = self._read()
+                index.update(submitted)
+                expired = time.time() - self.heartbeat
+                index = dict((k, v) for k, v in index.items() if v[1] >= expired)
+                fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'w') as f:
+                        json.dump(index, f)
+                    os.rename(tmp_path, self.path)
+                except BaseException:
+                    try:
+                        os.unlink(tmp_path)
+                    except OSError:
+                        pass
+                    raise
+                self._index = index
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
@@ -1,77 +1,69 @@
-import argparse
 import sys
 import os
+import errno
 import logging
+import select
 import time
 import signal
-import traceback
-from functools import reduce
+import collections
+import functools
+import resource
+import threading
 
 try:
-    import cStringIO as StringIO
+    import contextvars
 except ImportError:
-    import io as StringIO
+    contextvars = None
 
-# complex subprocess import
-SUBPROCESS_TIMEOUT = False
-try:
-    from subprocess import TimeoutExpired
+# modules that are not needed by every run (subprocess, argparse, queue, traceback, pexpect, etc.)
+# are imported on first use to keep the plugin start-up fast
 
-    SUBPROCESS_TIMEOUT = True
-    import subprocess
-except ImportError:
-    try:
-        import subprocess32 as subprocess
+_SUBPROCESS_NAMES = ('subprocess', 'SUBPROCESS_TIMEOUT', 'TimeoutExpired', 'STDOUT', 'check_output',
+                     'CalledProcessError')
 
-        SUBPROCESS_TIMEOUT = True
-    except ImportError:
-        SUBPROCESS_TIMEOUT = False
-        import subprocess
 
-try:   # adding py2.6 support for subprocess.check_output
-    from subprocess import STDOUT, check_output, CalledProcessError
-except ImportError:
-    STDOUT = subprocess.STDOUT
-
-    def check_output(*popenargs, **kwargs):
-        if 'stdout' in kwargs:  # pragma: no cover
-            raise ValueError('stdout argument not allowed, it will be overridden.')
-        if 'timeout' in kwargs:
-            timeout = kwargs['timeout']
-            del kwargs['timeout']
-        process = subprocess.Popen(stdout=subprocess.PIPE, *popenargs, **kwargs)
-        if SUBPROCESS_TIMEOUT:
-            output, _ = process.communicate(timeout=timeout)
-        else:
-            output, _ = process.communicate()
-        retcode = process.poll()
-        if retcode:
-            cmd = kwargs.get("args")
-            if cmd is None:
-                cmd = popenargs[0]
-            raise subprocess.CalledProcessError(retcode, cmd, output=output)
-        return output
-    subprocess.check_output = check_output
-    # overwrite CalledProcessError due to `output`
-    # keyword not being available (in 2.6)
-
-
-    class CalledProcessError(Exception):
-        def __init__(self, returncode, cmd, output=None):
-            self.returncode = returncode
-            self.cmd = cmd
-            self.output = output
-
-        def __str__(self):
-            return "Command '%s' returned non-zero exit status %d" % (
-                self.cmd, self.returncode)
-    subprocess.CalledProcessError = CalledProcessError
+def _import_subprocess():
+    # complex subprocess import
+    g = globals()
+    if 'subprocess' not in g:
+        try:
+            import subprocess
+            g['TimeoutExpired'] = subprocess.TimeoutExpired
+            g['SUBPROCESS_TIMEOUT'] = True
+        except AttributeError:
+            try:
+                import subprocess32 as subprocess
+                g['TimeoutExpired'] = subprocess.TimeoutExpired
+                g['SUBPROCESS_TIMEOUT'] = True
+            except ImportError:
+                g['SUBPROCESS_TIMEOUT'] = False
+        g['STDOUT'] = subprocess.STDOUT
+        g['check_output'] = subprocess.check_output
+        g['CalledProcessError'] = subprocess.CalledProcessError
+        g['subprocess'] = subprocess
+    return g['subprocess']
+
+
+def __getattr__(name):
+    # nap.core.subprocess, nap.core.SUBPROCESS_TIMEOUT, etc. are resolved on first access
+    if name in _SUBPROCESS_NAMES:
+        _import_subprocess()
+        if name in globals():
+            return globals()[name]
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+if sys.version_info < (3, 7):  # module __getattr__ not supported
+    _import_subprocess()
 
 import nap
 
 log = logging.getLogger()
 
 NAGIOS_CMD = '/var/nagios/rw/nagios.cmd'
+LIVESTATUS = '/var/nagios/rw/live'
+# writes up to PIPE_BUF bytes to a pipe are atomic, i.e. not interleaved with other writers
+PIPE_BUF = getattr(select, 'PIPE_BUF', 4096)
 SUBPROCESS_FAILED = -256
 
 
@@ -83,6 +75,167 @@ def _handle_timeout(signum, frame):
     raise TimeoutError("Backend execution timed out")
 
 
+_local_vars = list()
+
+
+class _LocalVar(object):
+    """
+    Value local to the current thread or asyncio task (context variables are per thread as well
+    as per task), falls back to thread local storage where context variables are not available
+    (nap.aio then swaps the values of each task in and out as it runs)
+    """
+    def __init__(self, name):
+        _local_vars.append(self)
+        if contextvars:
+            self._var = contextvars.ContextVar(name, default=None)
+        else:
+            self._var = None
+            self._local = threading.local()
+
+    def get(self):
+        if self._var:
+            return self._var.get()
+        return getattr(self._local, 'value', None)
+
+    def set(self, value):
+        if self._var:
+            self._var.set(value)
+        else:
+            self._local.value = value
+
+
+_bound_stream = _LocalVar('nap_bound_stream')
+_current_deadline = _LocalVar('nap_current_deadline')
+_now = getattr(time, 'monotonic', time.time)
+
+
+def _iscoroutinefunction(f):
+    # same as inspect.iscoroutinefunction (CO_COROUTINE flag), without importing inspect
+    return bool(getattr(getattr(f, '__code__', None), 'co_flags', 0) & 0x80)
+
+
+def _kill_process_group(pgid):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+class Deadline(object):
+    """
+    Point in time by which a metric (or the whole run) has to finish, deadline never extends past
+    the deadline of its parent. Child processes started by sub_process while the deadline is current
+    are registered, so that their process groups can be killed once it has passed.
+    """
+    def __init__(self, timeout=None, parent=None):
+        expires = list()
+        if timeout is not None:
+            expires.append(_now() + timeout)
+        if parent and parent.expires is not None:
+            expires.append(parent.expires)
+        self.expires = min(expires) if expires else None
+        self._pgids = set()
+        self._state = None
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        if self.expires is None:
+            return None
+        return max(self.expires - _now(), 0)
+
+    def expired(self):
+        return self.expires is not None and _now() >= self.expires
+
+    def clip(self, timeout):
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        if timeout is None:
+            return remaining
+        return min(timeout, remaining)
+
+    def add_process(self, pgid):
+        with self._lock:
+            self._pgids.add(pgid)
+
+    def remove_process(self, pgid):
+        with self._lock:
+            self._pgids.discard(pgid)
+
+    def kill(self):
+        with self._lock:
+            pgids = list(self._pgids)
+            self._pgids.clear()
+        for pgid in pgids:
+            log.debug("    Killing process group %d" % pgid)
+            _kill_process_group(pgid)
+
+    def complete(self):
+        # called by the metric once it finished, returns False if the metric was already abandoned
+        with self._lock:
+            if self._state is None:
+                self._state = 'completed'
+            return self._state == 'completed'
+
+    def abandon(self):
+        # called by the scheduler once deadline passed, returns False if the metric already completed
+        with self._lock:
+            if self._state is None:
+                self._state = 'abandoned'
+            return self._state == 'abandoned'
+
+
+class _OutputRouter(object):
+    """
+    File-like object installed as sys.stdout/sys.stderr while metrics run,
+    dispatches writes to the stream bound to the calling thread/task (or the default stream)
+    """
+    def __init__(self, default):
+        self._default = default
+        self.unbind()
+
+    def bind(self, stream):
+        _bound_stream.set(stream)
+
+    def unbind(self):
+        self.bind(None)
+
+    def _target(self):
+        return _bound_stream.get() or self._default
+
+    def write(self, s):
+        return self._target().write(s)
+
+    def flush(self):
+        return self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+
+# serializes emitting of metric results when running metrics concurrently
+_output_lock = threading.RLock()
+# streams of the process that output is restored to by default (updated by Plugin.run)
+sys_stdout = sys.stdout
+sys_stderr = sys.stderr
+
+
+def _redirect_output(stream):
+    if isinstance(sys.stdout, _OutputRouter):
+        sys.stdout.bind(stream)
+    else:
+        sys.stdout = stream
+        sys.stderr = stream
+
+
+def _restore_output(stream=None):
+    if isinstance(sys.stdout, _OutputRouter):
+        sys.stdout.bind(stream or sys_stdout)
+    else:
+        sys.stdout = stream or sys_stdout
+        sys.stderr = sys_stderr
+
+
 def get_status(ret_code):
     status_map = {nap.OK: "OK", nap.WARNING: "WARNING", nap.CRITICAL: "CRITICAL", nap.UNKNOWN: "UNKNOWN"}
     if ret_code in status_map.keys():
@@ -99,23 +252,130 @@ def get_code(status):
         return 255
 
 
-def sub_process(args, dry_run=False, timeout=3600, mode='popen', pexp_log=None, shell=False):
+def _popen(args, shell):
+    subprocess = _import_subprocess()
+    # child runs in its own process group, so that the whole group can be killed on timeout
+    if sys.version_info[0] >= 3:
+        session = {'start_new_session': True}
+    else:
+        session = {'preexec_fn': os.setsid}
+    return subprocess.Popen(args, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            stdin=None, **session)
+
+
+def _timeout_expired(args, timeout):
+    subprocess = _import_subprocess()
+    if hasattr(subprocess, 'TimeoutExpired'):
+        return subprocess.TimeoutExpired(args, timeout)
+    return TimeoutError("Subprocess %s timed out after %ss" % (args, timeout))
+
+
+class ProcessStream(object):
+    """
+    Iterates over output (stdout and stderr) of a command while it runs, line by line (or chunk by chunk
+    as read if lines is False) without keeping it in memory, lines longer than chunk_size are split.
+    Timeout is clipped to the deadline of the current metric, once it passes the child (and its process
+    group) is killed and TimeoutExpired raised (TimeoutError where subprocess doesn't support timeouts).
+    The child is also killed if the iteration is abandoned. Return code of the command is set once the
+    iteration finished.
+    """
+    def __init__(self, args, timeout=3600, shell=False, lines=True, chunk_size=65536):
+        self.args = args
+        self.timeout = timeout
+        self.shell = shell
+        self.lines = lines
+        self.chunk_size = chunk_size
+        self.returncode = None
+
+    def __iter__(self):
+        return self._read()
+
+    def _read(self):
+        deadline = _current_deadline.get()
+        timeout = deadline.clip(self.timeout) if deadline else self.timeout
+        expires = None if timeout is None else _now() + timeout
+        proc = _popen(self.args, self.shell)
+        fd = proc.stdout.fileno()
+        if deadline:
+            deadline.add_process(proc.pid)
+        try:
+            partial = b''
+            while True:
+                remaining = None if expires is None else expires - _now()
+                if remaining is not None and remaining <= 0:
+                    raise _timeout_expired(self.args, self.timeout)
+                if not select.select([fd], [], [], remaining)[0]:
+                    continue
+                chunk = os.read(fd, self.chunk_size)
+                if not chunk:
+                    break
+                if not self.lines:
+                    yield chunk
+                    continue
+                lines = (partial + chunk).split(b'\n')
+                partial = lines.pop()
+                for line in lines:
+                    yield line + b'\n'
+                if len(partial) >= self.chunk_size:
+                    yield partial  # overly long lines are passed in pieces
+                    partial = b''
+            if partial:
+                yield partial
+            proc.stdout.close()
+            self.returncode = proc.wait()
+        except BaseException:
+            _kill_process_group(proc.pid)
+            proc.stdout.close()
+            proc.wait()
+            raise
+        finally:
+            if deadline:
+                deadline.remove_process(proc.pid)
+
+
+def sub_process(args, dry_run=False, timeout=3600, mode='popen', pexp_log=None, shell=False, callback=None,
+                max_output=None, output_head=None, lines=True, session=None):
+    # runs command, returns tuple (return code, output); in popen mode output can be streamed to callback
+    # (called with every line, or chunk as read if lines is False), only the first output_head and last
+    # max_output - output_head bytes of the output are retained if max_output is set; in session mode
+    # command runs via long-lived shell from session (nap.session.SessionPool, shared pool by default)
     if dry_run:
         log.info("subprocess call: %s" % args)
         return 0, "success from dry-run"
+    if mode == 'session':
+        if session is None:
+            from nap import session as nap_session
+            session = nap_session.default_pool()
+        return session.run(args, timeout=timeout)
+    if mode == 'popen' and (callback or max_output):
+        stream = ProcessStream(args, timeout=timeout, shell=shell, lines=lines)
+        output = _ByteCapture(max_output or sys.maxsize, output_head)
+        for data in stream:
+            if callback:
+                callback(data)
+            output.write(data)
+        return stream.returncode, output.getvalue()
+    deadline = _current_deadline.get()
+    if deadline:
+        timeout = deadline.clip(timeout)
     if mode == 'popen':
+        subprocess = _import_subprocess()
+        proc = _popen(args, shell)
+        if deadline:
+            deadline.add_process(proc.pid)
         try:
-            if SUBPROCESS_TIMEOUT:
-                str_out = subprocess.check_output(args, shell=shell, stderr=subprocess.STDOUT,
-                                                  stdin=None, timeout=timeout)
+            if hasattr(subprocess, 'TimeoutExpired'):
+                str_out, _ = proc.communicate(timeout=timeout)
             else:
-                str_out = subprocess.check_output(args, shell=shell, stderr=subprocess.STDOUT, stdin=None)
-        except subprocess.CalledProcessError as e:
-            ret_code = e.returncode
-            str_out = e.output
-        else:
-            ret_code = 0
-        return ret_code, str_out
+                str_out, _ = proc.communicate()
+        except BaseException:
+            _kill_process_group(proc.pid)
+            proc.wait()
+            raise
+        finally:
+            if deadline:
+                deadline.remove_process(proc.pid)
+        return proc.returncode, str_out
     elif mode == 'pexpect':
         import pexpect
         log.debug("    Subprocess %s starting" % args)
@@ -138,10 +398,564 @@ def sub_process(args, dry_run=False, timeout=3600, mode='popen', pexp_log=None,
         return SUBPROCESS_FAILED, "unsupported backend {}".format(mode)
 
 
+def _chunk_lines(lines, size=PIPE_BUF):
+    # groups lines into chunks of up to size bytes (lines longer than size form a chunk of their own)
+    chunk = list()
+    chunk_size = 0
+    for line in lines:
+        if chunk and chunk_size + len(line) > size:
+            yield chunk
+            chunk = list()
+            chunk_size = 0
+        chunk.append(line)
+        chunk_size += len(line)
+    if chunk:
+        yield chunk
+
+
+class _BufferedWriter(object):
+    """
+    Base of passive result writers buffering commands, buffer is flushed by a timer flush_interval
+    seconds after the first command was buffered, so that commands aren't held while the plugin keeps
+    running (writers flush on their own when the buffer is full and on close).
+    """
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self._first = None
+        self._timer = None
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _schedule_flush(self):
+        # flushes buffer flush_interval seconds after the first command was buffered
+        if self._timer is None and self.flush_interval is not None:
+            self._timer = threading.Timer(self.flush_interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _cancel_flush(self):
+        if self._timer is not None:
+            if self._timer is not threading.current_thread():
+                self._timer.cancel()
+            self._timer = None
+
+    def flush(self):
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+
+
+class CommandPipe(_BufferedWriter):
+    """
+    Buffered writer for the Nagios command pipe, the pipe is opened once and external commands
+    are coalesced into writes of up to PIPE_BUF bytes (only complete lines are written so that
+    commands are never interleaved with other writers). Buffer is flushed once it reaches
+    max_buffer bytes, when the oldest buffered command is older than flush_interval seconds
+    (checked by a timer, so commands aren't held while the plugin keeps running) and on close.
+    With spool (nap.spool.Spool), pipe is written without blocking and commands that can't be
+    written (pipe missing or full) are spooled to disk instead, spooled commands are replayed
+    (ahead of the new ones) once the pipe is writable again. Commands longer than PIPE_BUF that
+    the pipe stops taking halfway are spooled after write_timeout seconds (clipped to deadline).
+    Callback submitted (given to write) is called once the command was written or spooled.
+    """
+    def __init__(self, path, max_buffer=64 * 1024, flush_interval=1.0, spool=None, write_timeout=10,
+                 deadline=None):
+        _BufferedWriter.__init__(self, flush_interval)
+        self.path = os.path.abspath(path)
+        self.max_buffer = max_buffer
+        self.spool = spool
+        self.write_timeout = write_timeout
+        self.deadline = deadline
+        self._fd = None
+        self._buffer = list()
+        self._buffered = 0
+        self._callbacks = list()
+
+    def _open(self):
+        flags = os.O_WRONLY | os.O_APPEND
+        if self.spool:
+            flags |= os.O_NONBLOCK
+        try:
+            self._fd = os.open(self.path, flags)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                log.error("Specified command file (%s) doesn't exist" % self.path)
+            raise
+
+    def _write_all(self, data):
+        # non-blocking writes of up to PIPE_BUF bytes are all or nothing, longer commands
+        # are finished once started (waiting for the pipe to become writable, up to write_timeout)
+        started = False
+        expires = None
+        while data:
+            try:
+                written = os.write(self._fd, data)
+            except OSError as e:
+                if e.errno != errno.EAGAIN or not started:
+                    raise
+                if expires is None:
+                    timeout = self.deadline.clip(self.write_timeout) if self.deadline else self.write_timeout
+                    expires = _now() + timeout
+                remaining = expires - _now()
+                if remaining <= 0 or not select.select([], [self._fd], [], remaining)[1]:
+                    raise OSError(errno.ETIMEDOUT, "Command pipe (%s) not drained in time" % self.path)
+                continue
+            started = True
+            data = data[written:]
+
+    def write_lines(self, lines):
+        # writes lines in chunks of complete lines, returns number of lines written (when spooling,
+        # writing stops once the pipe is full or not available)
+        written = 0
+        try:
+            if self._fd is None:
+                self._open()
+            for chunk in _chunk_lines(lines):
+                self._write_all(b''.join(chunk))
+                written += len(chunk)
+        except (IOError, OSError) as e:
+            if not self.spool:
+                raise
+            if e.errno != errno.EAGAIN:
+                self._close_fd()
+        return written
+
+    def write(self, command, submitted=None):
+        if not isinstance(command, bytes):
+            command = command.encode('utf-8')
+        if not command.endswith(b'\n'):
+            command += b'\n'
+        with self._lock:
+            if not self._buffer:
+                self._first = time.time()
+                self._schedule_flush()
+            self._buffer.append(command)
+            self._buffered += len(command)
+            if submitted:
+                self._callbacks.append(submitted)
+            if self._buffered >= self.max_buffer or time.time() - self._first >= self.flush_interval:
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            self._cancel_flush()
+            if not self._buffer:
+                return
+            lines = self._buffer
+            callbacks = self._callbacks
+            self._buffer = list()
+            self._buffered = 0
+            self._callbacks = list()
+            try:
+                if self.spool and not self.spool.replay(self):
+                    self.spool.append(lines)
+                    written = len(lines)
+                else:
+                    written = self.write_lines(lines)
+            except (IOError, OSError) as e:
+                log.exception("Exception while writing to command pipe (%s)" % str(e))
+                self._close_fd()
+                return
+            if written < len(lines):
+                log.warning("Command pipe (%s) not writable, spooling %d commands" %
+                            (self.path, len(lines) - written))
+                self.spool.append(lines[written:])
+            for submitted in callbacks:
+                submitted()
+
+    def _close_fd(self):
+        if self._fd is not None:
+            try:
+                os.close(self._fd)
+            except OSError:
+                pass
+            self._fd = None
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            if self.spool:
+                try:
+                    self.spool.replay(self)
+                    self.spool.close()
+                except (IOError, OSError) as e:
+                    log.exception("Exception while replaying spooled commands (%s)" % str(e))
+            self._close_fd()
+
+
+class CheckResultWriter(_BufferedWriter):
+    """
+    Writer submitting passive results as check result files to the Nagios check_result_path
+    directory, to be picked up by the check result reaper instead of processing one external command
+    per result. Takes the same PROCESS_SERVICE_CHECK_RESULT/PROCESS_HOST_CHECK_RESULT commands as
+    CommandPipe, results are buffered and written many per file (once max_results are buffered,
+    when the oldest buffered result is older than flush_interval seconds (checked by a timer, as in
+    CommandPipe) and on close). The .ok
+    marker is created only after the file is complete, so the reaper never reads partial files.
+    Callback submitted (given to write) is called once the result was written.
+    """
+    _NAME_CHARS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+
+    def __init__(self, path, max_results=1000, flush_interval=1.0):
+        _BufferedWriter.__init__(self, flush_interval)
+        self.path = os.path.abspath(path)
+        self.max_results = max_results
+        self._buffer = list()
+        self._callbacks = list()
+
+    @staticmethod
+    def _format(command):
+        # [timestamp] PROCESS_SERVICE_CHECK_RESULT;host;service;code;output (newlines escaped)
+        timestamp, _, command = command.partition('] ')
+        name, _, fields = command.partition(';')
+        if name == 'PROCESS_SERVICE_CHECK_RESULT':
+            host, service, code, output = fields.split(';', 3)
+        elif name == 'PROCESS_HOST_CHECK_RESULT':
+            host, code, output = fields.split(';', 2)
+            service = None
+        else:
+            raise ValueError("Unsupported command %s" % name)
+        lines = ['### Nagios %s Check Result ###' % ('Host' if service is None else 'Service'),
+                 'host_name=%s' % host]
+        if service is not None:
+            lines.append('service_description=%s' % service)
+        timestamp = int(timestamp.lstrip('['))
+        lines.extend(['check_type=1', 'check_options=0', 'scheduled_check=0', 'reschedule_check=0',
+                      'latency=0.0', 'start_time=%d.0' % timestamp, 'finish_time=%d.0' % timestamp,
+                      'early_timeout=0', 'exited_ok=1', 'return_code=%d' % int(code), 'output=%s' % output])
+        return '\n'.join(lines) + '\n\n'
+
+    def _create(self):
+        # reaper only processes files named c + 6 characters
+        import random
+        rand = random.SystemRandom()
+        while True:
+            name = os.path.join(self.path, 'c' + ''.join(rand.choice(self._NAME_CHARS) for _ in range(6)))
+            try:
+                return name, os.open(name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def write_results(self, results):
+        # writes formatted results to a new check result file and marks it as complete
+        name, fd = self._create()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(('### Active Check Result File ###\nfile_time=%d\n\n' % int(time.time())).encode('utf-8'))
+                f.write(''.join(results).encode('utf-8'))
+        except BaseException:
+            os.unlink(name)
+            raise
+        os.close(os.open(name + '.ok', os.O_WRONLY | os.O_CREAT, 0o644))
+        return name
+
+    def write(self, command, submitted=None):
+        if isinstance(command, bytes):
+            command = command.decode('utf-8')
+        try:
+            result = self._format(command.rstrip('\n'))
+        except ValueError as e:
+            log.error("Can't submit %r as check result (%s)" % (command, e))
+            return
+        with self._lock:
+            if not self._buffer:
+                self._first = time.time()
+                self._schedule_flush()
+            self._buffer.append(result)
+            if submitted:
+                self._callbacks.append(submitted)
+            if len(self._buffer) >= self.max_results or time.time() - self._first >= self.flush_interval:
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            self._cancel_flush()
+            if not self._buffer:
+                return
+            results = self._buffer
+            callbacks = self._callbacks
+            self._buffer = list()
+            self._callbacks = list()
+            try:
+                self.write_results(results)
+            except (IOError, OSError) as e:
+                log.exception("Exception while writing check results to %s (%s)" % (self.path, str(e)))
+                return
+            for submitted in callbacks:
+                submitted()
+
+
+def _passive_writer(path, spool=None, deadline=None):
+    # writer for passive results, check result files if path is a directory (Nagios check_result_path),
+    # command pipe otherwise
+    if os.path.isdir(path):
+        return CheckResultWriter(path)
+    return CommandPipe(path, spool=spool, deadline=deadline)
+
+
+# pipes in the metric output are escaped, so that output can't be mistaken for performance data
+PIPE_ESCAPE = '\\u2758'
+MAX_OUTPUT = 1024 * 1024
+
+
+def _escape_pipes(s):
+    if '|' in s:
+        return s.replace('|', PIPE_ESCAPE)
+    return s
+
+
+class _CaptureBuffer(object):
+    """
+    Bounded file-like buffer capturing metric output, pipes are escaped as data is written. Once more
+    than max_size characters were written, only the first head characters and the last max_size - head
+    characters are retained (with a marker of how much was dropped in between).
+    """
+    encoding = 'utf-8'
+
+    def __init__(self, max_size=MAX_OUTPUT, head=None):
+        self.max_size = max_size
+        self.head = max_size // 2 if head is None else min(head, max_size)
+        self.closed = False
+        self._reset()
+
+    def _reset(self):
+        self._head = list()
+        self._head_size = 0
+        self._tail = collections.deque()
+        self._tail_size = 0
+        self._dropped = 0
+        self._pos = None
+
+    def _append(self, s):
+        if self._head_size < self.head:
+            head = s[:self.head - self._head_size]
+            self._head.append(head)
+            self._head_size += len(head)
+            s = s[len(head):]
+            if not s:
+                return
+        self._tail.append(s)
+        self._tail_size += len(s)
+        excess = self._tail_size - (self.max_size - self.head)
+        while excess > 0:
+            first = self._tail[0]
+            if len(first) <= excess:
+                self._tail.popleft()
+                dropped = len(first)
+            else:
+                self._tail[0] = first[excess:]
+                dropped = excess
+            self._tail_size -= dropped
+            self._dropped += dropped
+            excess -= dropped
+
+    def write(self, s):
+        if self.closed:
+            raise ValueError("I/O operation on closed capture buffer")
+        if s:
+            self._append(_escape_pipes(s))
+            self._pos = None
+
+    def getvalue(self):
+        if self._dropped:
+            return "%s\n[... %d characters of output truncated ...]\n%s" % \
+                   (''.join(self._head), self._dropped, ''.join(self._tail))
+        return ''.join(self._head) + ''.join(self._tail)
+
+    def tell(self):
+        if self._pos is not None:
+            return self._pos
+        return self._head_size + self._tail_size
+
+    def seek(self, pos, whence=0):
+        self._pos = pos if whence == 0 else self._head_size + self._tail_size + pos
+        return self._pos
+
+    def truncate(self, size=None):
+        if size is None:
+            size = self.tell()
+        value = self.getvalue()[:size]
+        self._reset()
+        self._append(value)
+        return size
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+    def close(self):
+        self.closed = True
+        self._reset()
+
+
+class _ByteCapture(_CaptureBuffer):
+    # bounded buffer of raw (bytes) subprocess output, pipes are not escaped
+    def write(self, s):
+        if s:
+            self._append(s)
+
+    def getvalue(self):
+        if self._dropped:
+            return b''.join(self._head) + ('\n[... %d bytes of output truncated ...]\n' % self._dropped).encode() + \
+                b''.join(self._tail)
+        return b''.join(self._head) + b''.join(self._tail)
+
+
+PerfData = collections.namedtuple('PerfData', ['label', 'value', 'uom', 'warn', 'crit', 'vmin', 'vmax'])
+
+
+MetricStats = collections.namedtuple('MetricStats', ['wall', 'cpu', 'children_cpu', 'max_rss', 'children_max_rss'])
+
+
+class MetricResult(collections.namedtuple('MetricResult', ['name', 'status', 'summary', 'output'])):
+    # result of a metric as returned by Plugin.metric_results(), stats (MetricStats) holds its run time (s),
+    # CPU time (s) and peak RSS (KiB) of the plugin and its children (None if the metric didn't finish)
+    stats = None
+
+
+_RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+_RSS_UNIT = 1024 if sys.platform == 'darwin' else 1  # ru_maxrss is in bytes on macOS
+
+
+def _getrusage(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss // _RSS_UNIT
+
+
+class _Usage(object):
+    """
+    Resource usage of a metric, CPU time is taken for the calling thread where supported (process otherwise),
+    children are accounted once they were waited for (i.e. exact only if metrics run sequentially)
+    """
+    def __init__(self, thread_cpu=True):
+        self._start = _now()
+        self._cpu = _getrusage(_RUSAGE_THREAD)[0] if thread_cpu else None
+        self._children_cpu = _getrusage(resource.RUSAGE_CHILDREN)[0]
+
+    def stats(self):
+        cpu = None
+        if self._cpu is not None:
+            cpu = _getrusage(_RUSAGE_THREAD)[0] - self._cpu
+        children_cpu, children_max_rss = _getrusage(resource.RUSAGE_CHILDREN)
+        return MetricStats(_now() - self._start, cpu, children_cpu - self._children_cpu,
+                           _getrusage(resource.RUSAGE_SELF)[1], children_max_rss)
+
+
+def format_perf_data(perf_container, terminator=' '):
+    # single serializer of performance data, each entry (PerfData or sequence of the same 7 fields)
+    # is followed by terminator
+    if not perf_container:
+        return ''
+    return terminator.join(["%s=%s%s;%s;%s;%s;%s" % tuple(p) for p in perf_container]) + terminator
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    # performance data value as float (None if it isn't a plain number, e.g. U or threshold range)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _format_number(value):
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+class OpenMetricsWriter(object):
+    """
+    Collects status and performance data of metrics as OpenMetrics gauges (nap_status, nap_perf_data and
+    its thresholds, labelled by host and metric), exposition is written on close to path (atomically
+    replaced, e.g. for the node_exporter textfile collector) or stream. Non-numeric values are left out.
+    """
+    FAMILIES = (('nap_status', 'Status of the metric (0 OK, 1 WARNING, 2 CRITICAL, 3 UNKNOWN)'),
+                ('nap_perf_data', 'Performance data of the metric'),
+                ('nap_perf_data_warning', 'Warning threshold of the performance data'),
+                ('nap_perf_data_critical', 'Critical threshold of the performance data'),
+                ('nap_perf_data_min', 'Minimum value of the performance data'),
+                ('nap_perf_data_max', 'Maximum value of the performance data'))
+
+    def __init__(self, path=None, stream=None):
+        self.path = path
+        self.stream = stream
+        self._samples = dict((family, list()) for family, _ in self.FAMILIES)
+        self._lock = threading.Lock()
+
+    def add(self, host, metric, status, perf_container):
+        labels = 'host="%s",metric="%s"' % (_escape_label(host), _escape_label(metric))
+        samples = [('nap_status', labels, float(status))]
+        for p in perf_container:
+            p = PerfData(*p)
+            perf_labels = '%s,label="%s",uom="%s"' % (labels, _escape_label(p.label), _escape_label(p.uom))
+            for family, value in (('nap_perf_data', p.value), ('nap_perf_data_warning', p.warn),
+                                  ('nap_perf_data_critical', p.crit), ('nap_perf_data_min', p.vmin),
+                                  ('nap_perf_data_max', p.vmax)):
+                value = _number(value)
+                if value is not None:
+                    samples.append((family, perf_labels, value))
+        with self._lock:
+            for family, sample_labels, value in samples:
+                self._samples[family].append('%s{%s} %s\n' % (family, sample_labels, _format_number(value)))
+
+    def getvalue(self):
+        lines = list()
+        with self._lock:
+            for family, help_text in self.FAMILIES:
+                if self._samples[family]:
+                    lines.append('# TYPE %s gauge\n# HELP %s %s\n' % (family, family, help_text))
+                    lines.extend(self._samples[family])
+        lines.append('# EOF\n')
+        return ''.join(lines)
+
+    def close(self):
+        data = self.getvalue()
+        if not self.path:
+            stream = self.stream or sys.stdout
+            stream.write(data)
+            stream.flush()
+            return
+        import tempfile
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, self.path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+
+# output backends taking results of all metrics (passive too)
+STRUCTURED_OUTPUTS = ('ndjson', 'openmetrics')
+
+
 class PluginIO(object):
-    def __init__(self, metric_name, hostname, command_pipe=None, dry_run=False, pass_to_stdout=False):
-        sys.stdout = self._stdout = StringIO.StringIO()
-        sys.stderr = self._stdout
+    def __init__(self, metric_name, hostname, command_pipe=None, dry_run=False, pass_to_stdout=False,
+                 pipe_writer=None, max_output=MAX_OUTPUT, output_head=None, stdout=None, dedup=None,
+                 metrics_writer=None):
+        self._stdout = _CaptureBuffer(max_output, output_head)
+        self._output_stream = stdout  # plugin output is written to (defaults to sys_stdout)
+        _redirect_output(self._stdout)
         self._perf_container = list()
         self.metric_name = metric_name
         self.hostname = hostname
@@ -150,9 +964,33 @@ class PluginIO(object):
         self.command_pipe = command_pipe
         self.dry_run = dry_run
         self.pass_to_stdout = pass_to_stdout
+        self.pipe_writer = pipe_writer
+        self.dedup = dedup  # nap.cache.SubmissionIndex skipping unchanged passive results
+        self.metrics_writer = metrics_writer  # OpenMetricsWriter shared by the metrics of the run
+        self._forwarded = None  # passive results kept for the parent process (isolated metrics)
 
     def add_perf_data(self, label, value, uom='', warn='', crit='', vmin='', vmax=''):
-        self._perf_container.append([label, value, uom, warn, crit, vmin, vmax])
+        self._perf_container.append(PerfData(label, value, uom, warn, crit, vmin, vmax))
+
+    def add_perf_data_many(self, data, values=None, uom='', warn='', crit='', vmin='', vmax=''):
+        # adds performance data in bulk, either from labels and values (sequences or NumPy arrays),
+        # a dict mapping labels to values or a sequence of dicts with add_perf_data keyword arguments
+        if values is not None:
+            if hasattr(values, 'tolist'):
+                values = values.tolist()
+            if hasattr(data, 'tolist'):
+                data = data.tolist()
+            self._perf_container.extend([PerfData(label, value, uom, warn, crit, vmin, vmax)
+                                         for label, value in zip(data, values)])
+        elif isinstance(data, dict):
+            self._perf_container.extend([PerfData(label, value, uom, warn, crit, vmin, vmax)
+                                         for label, value in data.items()])
+        else:
+            defaults = {'uom': uom, 'warn': warn, 'crit': crit, 'vmin': vmin, 'vmax': vmax}
+            for entry in data:
+                fields = dict(defaults)
+                fields.update(entry)
+                self._perf_container.append(PerfData(**fields))
 
     def set_status(self, status, summary=None):
         self.status = status
@@ -167,8 +1005,8 @@ class PluginIO(object):
     def printf(self, s):
         self.out(s)
 
-    def truncate(self):
-        return self._stdout.truncate()
+    def truncate(self, size=None):
+        return self._stdout.truncate(size)
 
     def seek(self, pos):
         return self._stdout.seek(pos)
@@ -182,170 +1020,297 @@ class PluginIO(object):
     def close(self):
         return self._stdout.close()
 
-    def plugin_nagios_out(self):
-        sys.stdout.write("%s - %s" % (get_status(self.status), self.summary))
+    def _dump_result(self):
+        import json
+        return json.dumps({'status': self.status, 'summary': self.summary, 'details': self._stdout.getvalue(),
+                           'perf_data': self._perf_container}).encode('utf-8')
+
+    def _load_result(self, data):
+        import json
+        result = json.loads(data.decode('utf-8'))
+        self.status = result['status']
+        self.summary = result['summary']
+        self._perf_container = [PerfData(*p) for p in result['perf_data']]
+        self._stdout.write(result['details'])
+
+    def _summary_line(self, summary):
         if self._perf_container:
-            sys.stdout.write(" | ")
-            for perf_data in self._perf_container:
-                sys.stdout.write("%s=%s%s" % (perf_data[0], str(perf_data[1]), str(perf_data[2])))
-                sys.stdout.write(";%s" % perf_data[3])
-                sys.stdout.write(";%s" % perf_data[4])
-                sys.stdout.write(";%s" % perf_data[5])
-                sys.stdout.write(";%s" % perf_data[6])
-                sys.stdout.write(" ")
-        sys.stdout.write("\n")
-        sys.stdout.flush()
-        try:
-            sys.stdout.write(self._stdout.getvalue().encode('utf-8').replace(b'|', b'\u2758').decode(errors='ignore'))
-        except UnicodeError:
-            sys.stdout.write(self._stdout.getvalue().replace('|', '\u2758').decode('utf-8', errors='ignore'))
+            return "%s | %s" % (summary, format_perf_data(self._perf_container))
+        return summary
+
+    def plugin_nagios_out(self):
+        sys.stdout.write(self._summary_line("%s - %s" % (get_status(self.status), self.summary)) + "\n")
+        sys.stdout.write(self._stdout.getvalue())
         sys.stdout.flush()
 
     def plugin_check_mk_out(self):
-        sys.stdout.write("%s %s " % (str(self.status), self.metric_name.replace(" ", "_")))
-        if self._perf_container:
-            for perf_data in self._perf_container:
-                sys.stdout.write("%s=%s%s" % (perf_data[0], str(perf_data[1]), str(perf_data[2])))
-                sys.stdout.write(";%s" % perf_data[3])
-                sys.stdout.write(";%s" % perf_data[4])
-                sys.stdout.write(";%s" % perf_data[5])
-                sys.stdout.write(";%s" % perf_data[6])
-                sys.stdout.write("|")
-        sys.stdout.write(" %s" % self.summary)
-        sys.stdout.write("\n")
+        sys.stdout.write("%s %s %s %s\n" % (str(self.status), self.metric_name.replace(" ", "_"),
+                                            format_perf_data(self._perf_container, "|"), self.summary))
         sys.stdout.flush()
 
+    def plugin_ndjson_out(self):
+        # one JSON record per metric, written as soon as the metric finished
+        import json
+        perf_data = list()
+        for p in self._perf_container:
+            p = PerfData(*p)
+            record = {'label': p.label, 'value': p.value}
+            for key, value in (('uom', p.uom), ('warn', p.warn), ('crit', p.crit), ('min', p.vmin),
+                               ('max', p.vmax)):
+                if value != '':
+                    record[key] = value
+            perf_data.append(record)
+        sys.stdout.write(json.dumps({'timestamp': int(time.time()), 'host': self.hostname,
+                                     'metric': self.metric_name, 'status': self.status,
+                                     'state': get_status(self.status), 'summary': self.summary,
+                                     'perf_data': perf_data, 'details': self._stdout.getvalue()},
+                                    sort_keys=True) + '\n')
+        sys.stdout.flush()
+
+    def plugin_openmetrics_out(self):
+        if self.metrics_writer:
+            return self.metrics_writer.add(self.hostname, self.metric_name, self.status, self._perf_container)
+        writer = OpenMetricsWriter(stream=sys.stdout)
+        writer.add(self.hostname, self.metric_name, self.status, self._perf_container)
+        writer.close()
+
     def batch_passive_out(self, hostname, metric_name, status, summary, details, perf_container=None):
         assert self.command_pipe
 
-        if not self.dry_run and not os.path.exists(os.path.abspath(self.command_pipe)):
-            log.error("Specified command file (%s) doesn't exist" % os.path.abspath(self.command_pipe))
-            return
-
-        timestamp = str(int(time.time()))
-        host = hostname
-        service = metric_name
-        ret_code = status
         summary = "%s" % summary
         if perf_container:
-            summary += " | "
-            for perf_data in perf_container:
-                summary += "%s=%s%s" % (perf_data[0], str(perf_data[1]), str(perf_data[2]))
-                summary += ";%s" % perf_data[3]
-                summary += ";%s" % perf_data[4]
-                summary += ";%s" % perf_data[5]
-                summary += ";%s" % perf_data[6]
-                summary += " "
-        summary += "\\n"
-        details_raw = details.replace("\n", "\\n")
-        details = summary.encode('utf-8') + details_raw.encode('utf-8').replace(b'|', b'\u2758')
-        log.debug(repr(details))
-
-        if self.dry_run:
-            p_msg = "[%s] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s" % \
-                    (timestamp, host, service, ret_code, details.decode(errors='ignore'))
-            log.debug(p_msg)
-            return p_msg
-
-        try:
-            with open(os.path.abspath(self.command_pipe), "w") as cmd_pipe:
-                cmd_pipe.write("[%s] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n" %
-                               (timestamp, host, service, ret_code, details.decode(errors='ignore')))
-                cmd_pipe.flush()
-        except (IOError, OSError) as e:
-            log.exception("Exception while writing to command pipe (%s)" % str(e))
+            summary = "%s | %s" % (summary, format_perf_data(perf_container))
+        return self._submit(hostname, metric_name, status,
+                            summary + "\\n" + _escape_pipes(details).replace("\n", "\\n"))
 
     def plugin_passive_out(self):
         assert self.command_pipe
 
-        if not self.dry_run and not os.path.exists(os.path.abspath(self.command_pipe)):
-            log.error("Specified command file (%s) doesn't exist" % os.path.abspath(self.command_pipe))
-            return
-
         if self.summary == "Plugin didn't set summary message":
             log.debug("Skipping submission of passive metric results (%s) as no summary was set" % self.metric_name)
             return
 
-        timestamp = str(int(time.time()))
-        host = self.hostname
-        service = self.metric_name
-        ret_code = self.status
-        summary = "%s - %s" % (get_status(ret_code), self.summary)
-        if self._perf_container:
-            summary += " | "
-            for perf_data in self._perf_container:
-                summary += "%s=%s%s" % (perf_data[0], str(perf_data[1]), str(perf_data[2]))
-                summary += ";%s" % perf_data[3]
-                summary += ";%s" % perf_data[4]
-                summary += ";%s" % perf_data[5]
-                summary += ";%s" % perf_data[6]
-                summary += " "
-        summary += "\\n"
-        details_raw = self._stdout.getvalue().replace("\n", "\\n")
-        try:
-            details = summary.encode('utf-8') + details_raw.encode('utf-8').replace(b'|', b'\u2758')
-        except UnicodeError:
-            details = summary.encode('utf-8') + details_raw.replace('|', '\u2758')
-        log.debug(repr(details))
+        summary = self._summary_line("%s - %s" % (get_status(self.status), self.summary))
+        details = self._stdout.getvalue()
 
         if self.pass_to_stdout:
-            sys.stdout.write('\n====== {} {}'.format(service, summary.replace("\\n", "\n")))
-            sys.stdout.write('{}'.format(details_raw.replace("\\n", "\n")))
+            sys.stdout.write('\n====== {} {}\n'.format(self.metric_name, summary))
+            sys.stdout.write(details)
+
+        return self._submit(self.hostname, self.metric_name, self.status,
+                            summary + "\\n" + details.replace("\n", "\\n"))
+
+    def _submit(self, host, service, ret_code, output):
+        # output is the summary line and details with newlines escaped
+        log.debug(repr(output))
+        p_msg = "[%s] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s" % \
+                (str(int(time.time())), host, service, ret_code, output)
 
         if self.dry_run:
-            p_msg = "[%s] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s" % \
-                    (timestamp, host, service, ret_code, details.decode(errors='ignore'))
             log.debug(p_msg)
             return p_msg
 
-        try:
-            with open(os.path.abspath(self.command_pipe), "w") as cmd_pipe:
-                cmd_pipe.write("[%s] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n" %
-                               (timestamp, host, service, ret_code, details.decode(errors='ignore')))
-                cmd_pipe.flush()
-        except (IOError, OSError) as e:
-            log.exception("Exception while writing to command pipe (%s)" % str(e))
+        if self._forwarded is not None:
+            self._forwarded.append((host, service, ret_code, output))
+            return
 
-    def plugin_output(self, backend="nagios"):
-        sys.stdout = sys_stdout
-        sys.stderr = sys_stderr
-        if backend == 'nagios':
-            return self.plugin_nagios_out()
-        elif backend == 'check_mk':
-            return self.plugin_check_mk_out()
-        elif backend == 'passive':
-            return self.plugin_passive_out()
+        submitted = None
+        if self.dedup:
+            if not self.dedup.should_submit(host, service, ret_code, output):
+                log.debug("Skipping unchanged passive result of %s on %s" % (service, host))
+                return
+            # recorded once the writer reports the result was written (or spooled)
+            submitted = functools.partial(self.dedup.submitted, host, service, ret_code, output)
+
+        self._pipe_write(p_msg + "\n", submitted)
+
+    def _pipe_write(self, command, submitted=None):
+        if self.pipe_writer:
+            self.pipe_writer.write(command, submitted)
         else:
-            log.error("unsupported backend %s" % backend)
+            with _passive_writer(self.command_pipe) as cmd_pipe:
+                cmd_pipe.write(command, submitted)
+
+    def plugin_output(self, backend="nagios"):
+        with _output_lock:
+            _restore_output(self._output_stream)
+            if backend == 'nagios':
+                return self.plugin_nagios_out()
+            elif backend == 'check_mk':
+                return self.plugin_check_mk_out()
+            elif backend == 'passive':
+                return self.plugin_passive_out()
+            elif backend == 'ndjson':
+                return self.plugin_ndjson_out()
+            elif backend == 'openmetrics':
+                return self.plugin_openmetrics_out()
+            else:
+                log.error("unsupported backend %s" % backend)
+
+
+class IsolatedMetricError(Exception):
+    pass
+
+
+def _run_isolated(f, args, plugin_io, max_memory=None, max_cpu=None):
+    # runs metric in a forked child (in its own process group, optionally limited to max_memory bytes of
+    # address space and max_cpu seconds of CPU time), status, summary, perf data and output of the metric
+    # are passed back to plugin_io; passive results the metric submits are passed back as well and
+    # submitted by the parent (via its command pipe session and dedup index). Child is killed once the
+    # deadline of the metric passes
+    import json
+    deadline = _current_deadline.get()
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        code = 0
+        try:
+            os.setsid()
+            if max_memory:
+                resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+            if max_cpu:
+                # SIGXCPU once soft limit is reached, SIGKILL a second later
+                resource.setrlimit(resource.RLIMIT_CPU, (max_cpu, max_cpu + 1))
+            plugin_io._forwarded = list()
+            try:
+                f(args, plugin_io)
+                result = json.loads(plugin_io._dump_result().decode('utf-8'))
+            except BaseException as e:
+                import traceback
+                result = {'error': str(e) or e.__class__.__name__, 'traceback': traceback.format_exc()}
+            result['submissions'] = plugin_io._forwarded
+            data = json.dumps(result).encode('utf-8')
+            with os.fdopen(wfd, 'wb') as w:
+                w.write(data)
+        except BaseException:
+            code = 1
+        finally:
+            os._exit(code)
+    os.close(wfd)
+    if deadline:
+        deadline.add_process(pid)
+    chunks = list()
+    try:
+        with os.fdopen(rfd, 'rb') as r:
+            while True:
+                timeout = deadline.remaining() if deadline else None
+                if timeout == 0:
+                    raise TimeoutError("Isolated metric timed out")
+                if not select.select([r], [], [], timeout)[0]:
+                    continue
+                chunk = os.read(r.fileno(), 65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        _, status = os.waitpid(pid, 0)
+    except BaseException:
+        _kill_process_group(pid)
+        try:
+            os.kill(pid, signal.SIGKILL)  # in case child didn't get to setsid yet
+        except OSError:
+            pass
+        os.waitpid(pid, 0)
+        raise
+    finally:
+        if deadline:
+            deadline.remove_process(pid)
+    if os.WIFSIGNALED(status):
+        raise IsolatedMetricError("Isolated metric was killed by signal %d" % os.WTERMSIG(status))
+    if not chunks:
+        raise IsolatedMetricError("Isolated metric exited with %d" % os.WEXITSTATUS(status))
+    data = b''.join(chunks)
+    result = json.loads(data.decode('utf-8'))
+    for host, service, ret_code, output in result['submissions']:
+        plugin_io._submit(host, service, ret_code, output)
+    if 'error' in result:
+        plugin_io.write(result['traceback'])
+        raise IsolatedMetricError(result['error'])
+    plugin_io._load_result(data)
+
+
+# arguments not affecting results of the metrics (not part of the result cache key)
+_CACHE_IGNORED_ARGS = ('debug', 'print_all', 'timeout', 'command', 'spool', 'cache_dir', 'dry_run',
+                       'max_output', 'workers', 'worker', 'output', 'runtime_perf_data', 'profile',
+                       'hosts', 'hosts_file', 'hosts_query', 'livestatus', 'cached', 'dedup', 'textfile')
 
 
 class Plugin(object):
     def __init__(self, description=None, version="1.0"):
+        import argparse
         self._parser = argparse.ArgumentParser(description=description)
         self.args = None
         self.sequence = list()
         self._version = version
         self._results = list()
+        self._cmd_pipe = None
+        self._dedup = None
+        self._metrics_writer = None
+        self._stdout = None
+        self._refreshing = False
 
         # setup core arguments
         self._parser.add_argument('--version', action='version', version='%(prog)s ' + self._version)
-        self._parser.add_argument('-H', '--hostname', default="localhost",
-                                  help='Host name, IP Address, or unix socket (must be an absolute path)')
+        self._parser.add_argument('-H', '--hostname', action='append',
+                                  help='Host name, IP Address, or unix socket (must be an absolute path); '
+                                       'if repeated, metrics are run for each host (fan-out)')
+        self._parser.add_argument('--hosts-file',
+                                  help='File with hosts to run the metrics for (one per line, fan-out)')
+        self._parser.add_argument('--hosts-query',
+                                  help='Livestatus query returning hosts to run the metrics for (first column, '
+                                       'fan-out), e.g. "GET hosts\\nFilter: groups >= web"')
+        self._parser.add_argument('--livestatus', default=LIVESTATUS,
+                                  help='Livestatus socket used by --hosts-query (defaults to %(default)s)')
         self._parser.add_argument('-w', '--warning', type=int, help='Offset to result in warning status')
         self._parser.add_argument('-c', '--critical', type=int, help='Offset to result in critical status')
         self._parser.add_argument('-d', '--debug', action='store_true', help='Specify debugging mode')
         self._parser.add_argument('--print-all', action='store_true', help='Print output from all metrics to stdout')
         self._parser.add_argument('-p', '--prefix', help='Text to prepend to ever metric name', default='')
         self._parser.add_argument('-s', '--suffix', help='Text to append to every metric name', default='')
-        self._parser.add_argument('-t', '--timeout', help='Global timeout for plugin execution', type=int,
-                                  default=3700)
+        self._parser.add_argument('-t', '--timeout', type=int, default=3700,
+                                  help='Global timeout for plugin execution, metrics (and their subprocesses) '
+                                       'inherit the remaining time')
         self._parser.add_argument('-C', '--command', default=NAGIOS_CMD,
-                                  help='Nagios command pipe for submitting passive results')
+                                  help='Nagios command pipe for submitting passive results, or Nagios '
+                                       'check_result_path directory to submit them as check result files')
+        self._parser.add_argument('--spool',
+                                  help='Directory to spool passive results to when command pipe is not available '
+                                       'or full; spooled results are submitted once the command pipe is writable '
+                                       '(must be owned by the user with mode 0700)')
+        self._parser.add_argument('--dedup', type=int, metavar='HEARTBEAT',
+                                  help='Skip passive results with status, summary and performance data unchanged '
+                                       'since last submitted, unless submitted more than HEARTBEAT seconds ago '
+                                       '(submissions are tracked in --cache-dir)')
+        self._parser.add_argument('--cache-dir',
+                                  help='Directory to cache results of metrics with cache_ttl in (shared with other '
+                                       'plugin runs), defaults to ~/.cache/nap; must be owned by the user with mode '
+                                       '0700')
+        self._parser.add_argument('--runtime-perf-data', action='store_true',
+                                  help='Add run time of each metric as performance data (nap_runtime_<metric>)')
+        self._parser.add_argument('--profile', metavar='FILE',
+                                  help='Profile the run and store the statistics (pstats) in FILE')
         self._parser.add_argument('--dry-run', dest="dry_run", action="store_true",
                                   help="Dry run, will not execute commands and submit passive results")
+        self._parser.add_argument('--max-output', type=int, default=MAX_OUTPUT,
+                                  help='Maximum number of characters of detailed output retained per metric, '
+                                       'only beginning and end of longer output is kept')
+        self._parser.add_argument('-j', '--workers', type=int, default=1,
+                                  help='Number of metrics to run concurrently; metrics are started as soon as '
+                                       'the metrics they depend on have finished (defaults to 1)')
+        self._parser.add_argument('--worker', metavar='SOCKET',
+                                  help='Run as a long-lived worker executing checks sent to unix socket SOCKET '
+                                       '(or stdin if SOCKET is -), checks are sent by python -m nap.worker SOCKET')
+        self._parser.add_argument('--cached', type=int, metavar='INTERVAL',
+                                  help='With check_mk output, serve results from the agent-side cache (as cached '
+                                       'local checks) and refresh them in background once older than INTERVAL '
+                                       'seconds (cache is kept in --cache-dir)')
         self._parser.add_argument('-o', '--output', default="nagios",
-                                  help='Plugin output format; valid options are nagios, check_mk or passive '
-                                       '(via command pipe); defaults to nagios)')
+                                  help='Plugin output format; valid options are nagios, check_mk, passive '
+                                       '(via command pipe or check result files, see -C), ndjson (record per metric) '
+                                       'or openmetrics (see --textfile); defaults to nagios)')
+        self._parser.add_argument('--textfile', metavar='FILE',
+                                  help='File written (atomically replaced) by openmetrics output, e.g. for the '
+                                       'node_exporter textfile collector (defaults to stdout)')
 
     def add_argument(self, *args, **kwargs):
         self._parser.add_argument(*args, **kwargs)
@@ -353,99 +1318,504 @@ class Plugin(object):
     def metric_results(self):
         return self._results
 
-    def metric(self, seq=None, metric_name=None, passive=False):
+    def metric(self, seq=None, metric_name=None, passive=False, depends_on=None, timeout=None, cache_ttl=None,
+               isolate=False, max_memory=None, max_cpu=None):
         def decorator(f):
+            if isolate and _iscoroutinefunction(f):
+                raise ValueError("Coroutine metric %s can't be isolated" % f.__name__)
+            options = {'depends_on': list(depends_on or []), 'timeout': timeout, 'cache_ttl': cache_ttl,
+                       'isolate': isolate, 'max_memory': max_memory, 'max_cpu': max_cpu}
             if seq and seq > 0:
                 self.sequence.insert(seq - 1, (f, metric_name if metric_name else f.__name__,
-                                               passive))
+                                               passive, options))
             else:
                 self.sequence.append((f, metric_name if metric_name else f.__name__,
-                                      passive))
+                                      passive, options))
             log.debug("Registered callback: %s" % str(f.__name__))
             return f
 
         return decorator
 
-    def _partial_order(self):
+    def _dependencies(self):
+        # maps index in sequence to set of indices it depends on
+        names = dict()
+        for idx, entry in enumerate(self.sequence):
+            names.setdefault(entry[0], idx)
+            names.setdefault(entry[0].__name__, idx)
+            names.setdefault(entry[1], idx)
+        deps = dict()
+        for idx, entry in enumerate(self.sequence):
+            deps[idx] = set()
+            for dep in entry[3]['depends_on'] if len(entry) > 3 else []:
+                if dep not in names:
+                    raise ValueError("Metric %s depends on unknown metric %s" % (entry[1], dep))
+                deps[idx].add(names[dep])
+            deps[idx].discard(idx)
+        return deps
+
+    def _partial_order(self, deps=None):
+        # topological sort of the sequence, ties are resolved by the registration order
+        if deps is None:
+            deps = self._dependencies()
+        pending = dict((k, set(v)) for k, v in deps.items())
         partial_order = list()
-        all_keys = set(key for key in self._dps_tree.keys())
-        for k, v in self._dps_tree.items():
-            v.discard(k)
-        extra_items_in_deps = reduce(set.union, self._dps_tree.values()) - set(self._dps_tree.keys())
-        for item in extra_items_in_deps:
-            if item:
-                self._dps_tree[item] = set()
-        while True:
-            ordered = set(item for item, dep in self._dps_tree.items() if not dep)
+        while pending:
+            ordered = sorted(item for item, dep in pending.items() if not dep)
             if not ordered:
-                break
+                raise ValueError("A cyclic dependency exists amongst %r" %
+                                 [self.sequence[k][1] for k in sorted(pending.keys())])
             partial_order.extend(ordered)
-            for item, dep in self._dps_tree.items():
-                self._dps_tree_tmp = dict()
-                if item not in ordered:
-                    self._dps_tree_tmp[item] = (dep - ordered)
-            self._dps_tree = self._dps_tree_tmp
-        assert not self._dps_tree, "A cyclic dependency exists amongst %r" % self._dps_tree
-        rest = list(all_keys - set(partial_order))
-        partial_order.extend(rest)
+            for item in ordered:
+                del pending[item]
+            for dep in pending.values():
+                dep.difference_update(ordered)
         return partial_order
 
-    def run(self):
-        self.args = self._parser.parse_args()
-
-        global sys_stdout, sys_stderr, plugin_stdout
-        sys_stdout = sys.stdout
-        sys_stderr = sys.stderr
-
+    def _metric_name(self, entry):
+        metric_name = entry[1]
+        if self.args.prefix:
+            metric_name = self.args.prefix + '-' + metric_name
+        if self.args.suffix:
+            metric_name = metric_name + '-' + self.args.suffix
+        return metric_name
+
+    def _entry_args(self, entry):
+        # arguments the metric is called with (per host when fanning out)
+        return (entry[3].get('args') if len(entry) > 3 else None) or self.args
+
+    def _plugin_io(self, entry):
+        return PluginIO(self._metric_name(entry), self._entry_args(entry).hostname,
+                        command_pipe=self.args.command, dry_run=self.args.dry_run,
+                        pass_to_stdout=self.args.print_all, pipe_writer=self._cmd_pipe,
+                        max_output=self.args.max_output, stdout=self._stdout, dedup=self._dedup,
+                        metrics_writer=self._metrics_writer)
+
+    def _output_backend(self, entry):
+        passive = entry[2]  # output per metric
+        if passive and self.args.output not in STRUCTURED_OUTPUTS:
+            return "passive"
+        return self.args.output
+
+    def _unfinished(self, entry, reason):
+        output = self._output_backend(entry)
+        plugin_io = self._plugin_io(entry)
+        plugin_io.set_status(nap.UNKNOWN, "Metric didn't finish (%s)" % reason)
+        plugin_io.plugin_output(backend=output)
+        plugin_io.close()
+        return MetricResult(entry[0].__name__, plugin_io.status, plugin_io.summary, output)
+
+    def _record_usage(self, entry, plugin_io, usage):
+        stats = usage.stats()
+        log.debug("   Finished %s in %.3fs (cpu %s, children cpu %.3fs, max rss %dKiB)" %
+                  (entry[1], stats.wall, 'n/a' if stats.cpu is None else '%.3fs' % stats.cpu,
+                   stats.children_cpu, stats.max_rss))
+        if self.args.runtime_perf_data:
+            plugin_io.add_perf_data('nap_runtime_%s' % entry[1].replace(' ', '_'), '%.3f' % stats.wall, uom='s')
+        return stats
+
+    def _identity(self):
+        # plugin script and the metrics it registers, keeps apart entries of plugins sharing a cache directory
+        return '%s\n%s' % (os.path.abspath(sys.argv[0]), ' '.join(entry[1] for entry in self.sequence))
+
+    def _cache_key(self, entry):
+        # results are shared by runs of the same metric of the same plugin with the same arguments (except
+        # those controlling how the plugin runs and reports)
+        args = dict((k, v) for k, v in vars(self._entry_args(entry)).items() if k not in _CACHE_IGNORED_ARGS)
+        return '%s\n%s\n%s' % (self._identity(), self._metric_name(entry),
+                               sorted((k, repr(v)) for k, v in args.items()))
+
+    def _result_cache(self):
+        from nap.cache import FileCache
+        return FileCache(self.args.cache_dir)
+
+    def _invoke(self, entry, plugin_io):
+        options = entry[3] if len(entry) > 3 else dict()
+        if options.get('isolate'):
+            return _run_isolated(entry[0], self._entry_args(entry), plugin_io, max_memory=options.get('max_memory'),
+                                 max_cpu=options.get('max_cpu'))
+        return entry[0](self._entry_args(entry), plugin_io)
+
+    def _call_metric(self, entry, plugin_io):
+        # calls metric, its result is replayed from the cache instead while it's younger than cache_ttl;
+        # concurrent runs needing the same stale result wait for the first one to compute it
+        cache_ttl = entry[3].get('cache_ttl') if len(entry) > 3 else None
+        if not cache_ttl:
+            return self._invoke(entry, plugin_io)
+        measured = list()
+
+        def measure():
+            self._invoke(entry, plugin_io)
+            measured.append(True)
+            return plugin_io._dump_result()
+
+        data = self._result_cache().get_or_set(self._cache_key(entry), measure, ttl=cache_ttl)
+        if not measured:
+            log.debug("   Replaying cached result of %s" % str(entry[0].__name__))
+            plugin_io._load_result(data)
+
+    def _deadline(self, entry, run_deadline):
+        timeout = entry[3].get('timeout') if len(entry) > 3 else None
+        return Deadline(timeout, parent=run_deadline)
+
+    def _run_metric(self, entry, deadline, alarm=True):
+        # runs metric and emits its output unless it was abandoned by the scheduler in the meantime,
+        # alarm interrupts the metric once deadline passes (only possible in the main thread),
+        # previous SIGALRM handler is restored afterwards
+        output = self._output_backend(entry)
+        plugin_io = self._plugin_io(entry)
+        plugin_function = entry[0]
+        exc = None
+        alarm = alarm and deadline.expires is not None
+        previous_handler = None
+        _current_deadline.set(deadline)
+        usage = _Usage()
+        try:
+            if alarm:
+                previous_handler = signal.signal(signal.SIGALRM, _handle_timeout)
+                signal.setitimer(signal.ITIMER_REAL, max(deadline.remaining(), 0.001))
+            log.debug("   Function call: %s" % str(plugin_function.__name__))
+            self._call_metric(entry, plugin_io)
+        except Exception as e:
+            plugin_io.status = nap.UNKNOWN
+            plugin_io.summary = "Exception caught while executing plugin (%s)" % e
+            import traceback
+            exc = traceback.format_exc()
+        finally:
+            if alarm:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, previous_handler)
+            _current_deadline.set(None)
+        stats = self._record_usage(entry, plugin_io, usage)
+        try:
+            if not deadline.complete():
+                return None
+            with _output_lock:
+                plugin_io.plugin_output(backend=output)
+                if exc:
+                    sys.stdout.write(exc)
+        finally:
+            plugin_io.close()
+        result = MetricResult(plugin_function.__name__, plugin_io.status, plugin_io.summary, output)
+        result.stats = stats
+        return result
+
+    def _run_parallel(self, deps, workers, run_deadline):
+        # dispatches metrics whose dependencies have finished to at most `workers` threads,
+        # metrics still running past their deadline are abandoned (and their children killed),
+        # results are kept in the sequence order
+        results = [None] * len(self.sequence)
+        pending = dict((k, set(v)) for k, v in deps.items())
+        dependents = dict((k, set()) for k in deps.keys())
+        for k, v in deps.items():
+            for dep in v:
+                dependents[dep].add(k)
+        ready = list()
+        running = dict()
+        try:
+            import queue
+        except ImportError:
+            import Queue as queue
+        done = queue.Queue()
+
+        def finished(idx):
+            self._results = [r for r in results if r]
+            for k in sorted(dependents[idx]):
+                pending[k].discard(idx)
+                if not pending[k]:
+                    del pending[k]
+                    ready.append(k)
+            ready.sort()
+
+        def worker(idx, deadline):
+            try:
+                result = self._run_metric(self.sequence[idx], deadline, alarm=False)
+                if result:
+                    results[idx] = result
+            finally:
+                _bound_stream.set(None)
+                done.put(idx)
+
+        ready.extend(sorted(k for k, v in pending.items() if not v))
+        for k in ready:
+            del pending[k]
+        while ready or running:
+            while ready and len(running) < workers:
+                idx = ready.pop(0)
+                if run_deadline.expired():
+                    results[idx] = self._unfinished(self.sequence[idx], "timed out")
+                    finished(idx)
+                    continue
+                running[idx] = self._deadline(self.sequence[idx], run_deadline)
+                t = threading.Thread(target=worker, args=(idx, running[idx]))
+                t.daemon = True
+                t.start()
+            if not running:
+                continue
+            remaining = [d.remaining() for d in running.values() if d.expires is not None]
+            try:
+                idx = done.get(timeout=min([1] + remaining) + 0.01)
+            except queue.Empty:
+                for idx, deadline in list(running.items()):
+                    if deadline.expired() and deadline.abandon():
+                        deadline.kill()
+                        results[idx] = self._unfinished(self.sequence[idx], "timed out")
+                        del running[idx]
+                        finished(idx)
+                continue
+            if idx in running:
+                del running[idx]
+                finished(idx)
+        self._results = list(results)
+
+    def _fanout_hosts(self):
+        # hosts to run the metrics for, None unless several hosts were given (or read from file/livestatus);
+        # empty if the hosts file or query has no hosts
+        hosts = list(self.args.hosts)
+        if self.args.hosts_file:
+            with open(self.args.hosts_file) as f:
+                hosts.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+        if self.args.hosts_query:
+            from nap import livestatus
+            request = self.args.hosts_query.replace('\\n', '\n')
+            if 'Columns:' not in request:
+                request += '\nColumns: name'
+            hosts.extend(str(row[0]) for row in livestatus.iter_query(self.args.livestatus, request))
+        if len(hosts) < 2 and not (self.args.hosts_file or self.args.hosts_query):
+            return None
+        seen = set()
+        return [h for h in hosts if not (h in seen or seen.add(h))]
+
+    def _run_fanout(self, hosts, deps, run_deadline):
+        # runs every metric for every host (each host with its own copy of the arguments), at most
+        # `workers` at a time, results are submitted as passive (via the command pipe of the run, or
+        # written as records by structured outputs) and the sweep is summarized by an active result with
+        # the worst status seen (UNKNOWN if there are no hosts)
+        import copy
+        sequence = self.sequence
+        fanout = list()
+        fanout_deps = dict()
+        for h, host in enumerate(hosts):
+            args = copy.copy(self.args)
+            args.hostname = host
+            for idx, entry in enumerate(sequence):
+                options = dict(entry[3]) if len(entry) > 3 else dict()
+                options['args'] = args
+                fanout.append((entry[0], entry[1], True, options))
+                fanout_deps[h * len(sequence) + idx] = set(h * len(sequence) + d for d in deps[idx])
+        log.debug("Fan-out of %d metrics to %d hosts" % (len(sequence), len(hosts)))
+        # metrics are scheduled from the fanned out sequence for the duration of the sweep
+        if fanout:
+            self.sequence = fanout
+            try:
+                if any(_iscoroutinefunction(entry[0]) for entry in sequence):
+                    from nap import aio
+                    aio.run_metrics(self, fanout_deps, self.args.workers, run_deadline)
+                else:
+                    self._run_parallel(fanout_deps, self.args.workers, run_deadline)
+            finally:
+                self.sequence = sequence
+
+        counts = dict((code, 0) for code in (nap.OK, nap.WARNING, nap.CRITICAL, nap.UNKNOWN))
+        details = list()
+        for idx, result in enumerate(self._results):
+            status = result[1] if result[1] in counts else nap.UNKNOWN
+            counts[status] += 1
+            if status != nap.OK:
+                details.append("%s %s %s: %s" % (get_status(status), hosts[idx // len(sequence)],
+                                                 self._metric_name(fanout[idx]), result[2]))
+        entry = (None, 'fanout', False, dict())
+        plugin_io = self._plugin_io(entry)
+        if not hosts:
+            plugin_io.set_status(nap.UNKNOWN, "No hosts to check")
+        else:
+            plugin_io.set_status(max([code for code, count in counts.items() if count] or [nap.OK]),
+                                 "Checked %d hosts (%d metrics): %d OK, %d WARNING, %d CRITICAL, %d UNKNOWN" %
+                                 (len(hosts), len(fanout), counts[nap.OK], counts[nap.WARNING],
+                                  counts[nap.CRITICAL], counts[nap.UNKNOWN]))
+        plugin_io.add_perf_data('hosts', len(hosts))
+        for code in sorted(counts.keys()):
+            plugin_io.add_perf_data(get_status(code).lower(), counts[code])
+        plugin_io.write(''.join(line + '\n' for line in details))
+        output = self._output_backend(entry)
+        plugin_io.plugin_output(backend=output)
+        plugin_io.close()
+        self._results.append(MetricResult('fanout', plugin_io.status, plugin_io.summary, output))
+
+    def _execute_cached(self, argv, stdout):
+        # check_mk local checks are served from the agent-side cache, prefixed by cached(<timestamp>,<interval>)
+        # (time the results were measured and the refresh interval), so that agent poll returns immediately;
+        # results older than the interval are refreshed by a background (forked) child
+        import json
+        from nap.cache import FileCache
+        cache = FileCache(self.args.cache_dir)
+        key = 'check_mk\n%s\n%r' % (self._identity(), sys.argv[1:] if argv is None else list(argv))
+        data = cache.get(key, ttl=float('inf'))
+        if data is None:
+            data = self._refresh_cached(argv, cache, key)
+        elif cache.age(key) >= self.args.cached:
+            self._refresh_cached(argv, cache, key, background=True)
+        result = json.loads(data.decode('utf-8'))
+        prefix = 'cached(%d,%d) ' % (result['timestamp'], self.args.cached)
+        stdout.write(''.join(prefix + line + '\n' for line in result['output'].splitlines()))
+        stdout.flush()
+        return result['code']
+
+    def _refresh_cached(self, argv, cache, key, background=False):
+        # runs the metrics and stores their output in the cache, only one refresh runs at a time (background
+        # refresh is skipped if another one is running, foreground refresh waits for its result)
+        import fcntl
+        import json
+        try:
+            from StringIO import StringIO
+        except ImportError:
+            from io import StringIO
+        lock = open(cache._lock_path(cache._digest(key)), 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | (fcntl.LOCK_NB if background else 0))
+        except (IOError, OSError):
+            lock.close()
+            if not background:
+                raise  # nothing to serve without the lock
+            return None
+        if background:
+            if os.fork():
+                lock.close()  # lock is held by the child
+                return None
+            # child is detached from the agent (which waits for the plugin's output to be closed)
+            os.setsid()
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+        try:
+            data = cache.get(key, ttl=self.args.cached) if not background else None
+            if data is None:
+                timestamp = time.time()
+                output = StringIO()
+                self._refreshing = True
+                try:
+                    code = self.execute(argv, stdout=output)
+                finally:
+                    self._refreshing = False
+                data = json.dumps({'timestamp': int(timestamp), 'code': code,
+                                   'output': output.getvalue()}).encode('utf-8')
+                cache.set(key, data)
+        except BaseException:
+            if background:
+                os._exit(1)
+            raise
+        finally:
+            if not background:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                lock.close()
+        if background:
+            os._exit(0)
+        return data
+
+    def execute(self, argv=None, stdout=None):
+        # runs the metrics and returns the exit code, output is written to stdout (defaults to sys.stdout);
+        # process-wide state (sys.stdout, sys.stderr, signal handlers, logging) is left as it was found,
+        # so that the same plugin can execute many times in a single process (see nap.worker)
+        self.args = self._parser.parse_args(argv)
+        self.args.hosts = self.args.hostname or list()
+        self.args.hostname = self.args.hosts[-1] if self.args.hosts else 'localhost'
+        self._results = list()
+        if self.args.cached and self.args.output == 'check_mk' and not self._refreshing:
+            return self._execute_cached(argv, stdout or sys.stdout)
+        self._stdout = stdout or sys.stdout
+
+        saved_streams = sys.stdout, sys.stderr
+        saved_binding = _bound_stream.get()
+        saved_level = log.level
+        fh = None
+        if not isinstance(sys.stdout, _OutputRouter):
+            sys.stdout = _OutputRouter(saved_streams[0])
+            sys.stderr = _OutputRouter(saved_streams[1])
         if self.args.debug:
             log.setLevel(logging.DEBUG)
             formatter = logging.Formatter(fmt='%(asctime)s %(levelname)s %(module)s[%(process)d]: %(message)s',
                                           datefmt='%b %d %H:%M:%S')
-            if sys.version_info[0] == 2 and sys.version_info[1] <= 6:
-                fh = logging.StreamHandler(strm=sys_stdout)
-            else:
-                fh = logging.StreamHandler(stream=sys_stdout)
+            fh = logging.StreamHandler(stream=self._stdout)
             fh.setFormatter(formatter)
             log.addHandler(fh)
+            _bound_stream.set(self._stdout)
         else:
             # prevent unintentional output from plugin
-            sys.stdout = plugin_stdout = StringIO.StringIO()
-            sys.stderr = plugin_stdout
-
-        # run logic, metric call
-        log.debug("Call sequence: %s " % str(self.sequence))
-        for entry in self.sequence:
-            metric_name = entry[1]
-            if self.args.prefix:
-                metric_name = self.args.prefix + '-' + metric_name
-            if self.args.suffix:
-                metric_name = metric_name + '-' + self.args.suffix
-            passive = entry[2]  # output per metric
-            if passive:
-                output = "passive"
-            else:
-                output = self.args.output
-            plugin_io = PluginIO(metric_name, self.args.hostname,
-                                 command_pipe=self.args.command, dry_run=self.args.dry_run,
-                                 pass_to_stdout=self.args.print_all)
-            plugin_function = entry[0]
+            _bound_stream.set(_CaptureBuffer(self.args.max_output))
+        profiler = None
+        if self.args.profile:
+            # only the thread running the plugin is profiled (not the worker threads)
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        try:
+            # run logic, metric call
+            log.debug("Call sequence: %s " % str(self.sequence))
+            deps = self._dependencies()
+            order = self._partial_order(deps)
+            # metrics inherit deadline of the whole run
+            run_deadline = Deadline(self.args.timeout)
+            # passive results are submitted via single command pipe (or check result writer) session
+            spool = None
+            if self.args.spool:
+                from nap.spool import Spool
+                spool = Spool(self.args.spool)
+            self._cmd_pipe = _passive_writer(self.args.command, spool=spool, deadline=run_deadline)
+            if self.args.dedup and not self.args.dry_run:
+                from nap.cache import SubmissionIndex
+                self._dedup = SubmissionIndex(self.args.cache_dir, heartbeat=self.args.dedup)
+            if self.args.output == 'openmetrics':
+                self._metrics_writer = OpenMetricsWriter(self.args.textfile, stream=self._stdout)
             try:
-                signal.signal(signal.SIGALRM, _handle_timeout)
-                signal.alarm(self.args.timeout)
-                log.debug("   Function call: %s" % str(plugin_function.__name__))
-                plugin_function(self.args, plugin_io)
-                plugin_io.plugin_output(backend=output)
-            except Exception as e:
-                plugin_io.status = nap.UNKNOWN
-                plugin_io.summary = "Exception caught while executing plugin (%s)" % e
-                plugin_io.plugin_output(backend=output)
-                traceback.print_exc(file=sys.stdout)
+                hosts = self._fanout_hosts()
+                if hosts is not None:
+                    self._run_fanout(hosts, deps, run_deadline)
+                elif any(_iscoroutinefunction(entry[0]) for entry in self.sequence):
+                    from nap import aio
+                    aio.run_metrics(self, deps, self.args.workers, run_deadline)
+                elif self.args.workers > 1:
+                    self._run_parallel(deps, self.args.workers, run_deadline)
+                else:
+                    alarm = threading.current_thread().name == 'MainThread'
+                    for idx in order:
+                        entry = self.sequence[idx]
+                        if run_deadline.expired():
+                            self._results.append(self._unfinished(entry, "timed out"))
+                        else:
+                            self._results.append(self._run_metric(entry, self._deadline(entry, run_deadline),
+                                                                  alarm=alarm))
             finally:
-                self._results.append((plugin_function.__name__, plugin_io.status, plugin_io.summary, output))
-                plugin_io.close()
-                signal.alarm(0)
+                self._cmd_pipe.close()
+                if self._dedup:
+                    self._dedup.close()
+                    self._dedup = None
+                if self._metrics_writer:
+                    self._metrics_writer.close()
+                    self._metrics_writer = None
+        finally:
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(self.args.profile)
+            _bound_stream.set(saved_binding)
+            sys.stdout, sys.stderr = saved_streams
+            if fh:
+                log.removeHandler(fh)
+                log.setLevel(saved_level)
 
         # exit status is taken from first active metric executed
-        ret_code = [e[1] for e in self._results if e[3] != "passive"][0]
+        return [e[1] for e in self._results if e and e[3] != "passive"][0]
+
+    def run(self, argv=None):
+        global sys_stdout, sys_stderr
+        sys_stdout = sys.stdout
+        sys_stderr = sys.stderr
+
+        args = self._parser.parse_args(argv)
+        if args.worker:
+            from nap import worker
+            worker.serve(self, None if args.worker == '-' else args.worker)
+            return
+
+        ret_code = self.execute(argv)
         if not self.args.dry_run:
             os._exit(ret_code)
@@ -1,6 +1,7 @@
 import logging
 import json
 import socket
+import threading
 import time
 
 from messaging.message import Message
@@ -8,16 +9,79 @@ from messaging.queue.dqs import DQS
 
 log = logging.getLogger("nap")
 
+_hostname = None
+_writers = dict()
+_writers_lock = threading.Lock()
+
+
+def _measurement_agent():
+    global _hostname
+    if _hostname is None:
+        _hostname = socket.gethostname()
+    return _hostname
+
+
+class QueueWriter(object):
+    """
+    Writer re-using the same directory queue and message header for all events it enqueues,
+    enqueue_many serializes events in batches and reports throughput per batch (via log and
+    optional callback taking number of events and elapsed time)
+    """
+    def __init__(self, dirq, destination, report=None):
+        self.dirq = dirq
+        self.destination = destination
+        self.report = report
+        self._header = {'measurement_agent': _measurement_agent(),
+                        'destination': destination
+                        }
+        self._mq = DQS(path=dirq)
+
+    def _message(self, event):
+        if 'timestamp' not in event.keys():
+            event['timestamp'] = time.time()
+        msg = Message(body=json.dumps(event), header=dict(self._header))
+        msg.is_text = True
+        return msg
+
+    def enqueue(self, event):
+        return self._mq.add_message(self._message(event))
+
+    def _write_batch(self, batch):
+        start = time.time()
+        messages = [self._message(event) for event in batch]
+        for msg in messages:
+            self._mq.add_message(msg)
+        elapsed = time.time() - start
+        log.debug("Enqueued %d events to %s in %.3fs (%.0f events/s)" %
+                  (len(batch), self.dirq, elapsed, len(batch) / elapsed if elapsed else float('inf')))
+        if self.report:
+            self.report(len(batch), elapsed)
+        return len(batch)
+
+    def enqueue_many(self, events, batch_size=1000):
+        total = 0
+        batch = list()
+        for event in events:
+            batch.append(event)
+            if len(batch) >= batch_size:
+                total += self._write_batch(batch)
+                batch = list()
+        if batch:
+            total += self._write_batch(batch)
+        return total
+
+
+def writer(dirq, destination):
+    # shared writer per queue and destination
+    with _writers_lock:
+        if (dirq, destination) not in _writers:
+            _writers[(dirq, destination)] = QueueWriter(dirq, destination)
+        return _writers[(dirq, destination)]
+
 
 def enqueue(dirq, destination, event):
-    mq_header = {'measurement_agent': socket.gethostname(),
-                 'destination': destination
-                 }
-    if 'timestamp' not in event.keys():
-        event['timestamp'] = time.time()
-    mq_body = json.dumps(event)
-
-    msg = Message(body=mq_body, header=mq_header)
-    msg.is_text = True
-    mq = DQS(path=dirq)
-    mq.add_message(msg)
+    writer(dirq, destination).enqueue(event)
+
+
+def enqueue_many(dirq, destination, events, batch_size=1000):
+    return writer(dirq, destination).enqueue_many(events, batch_size=batch_size)
@@ -1,32 +1,347 @@
+import codecs
+import collections
+import os
+import re
 import socket
 import json
+import threading
+import time
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
-# Live status helper function - returns JSON object,
-# address is either path to the live status pipe or
-# a tuple (host, port) for remote connection
-def query(address, request):
-    sock = None
-    try:
-        if len(address) == 2:
-            host_addr = socket.getaddrinfo(address[0], 80, 0, 0, socket.IPPROTO_TCP)
-            ip6 = filter(lambda x: x[0] == socket.AF_INET6, host_addr)
-            if ip6:
-                sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+
+class LivestatusError(Exception):
+    def __init__(self, code, message):
+        Exception.__init__(self, "Livestatus query failed with %s (%s)" % (code, message))
+        self.code = code
+        self.message = message
+
+
+def _recv_exactly(sock, size):
+    chunks = list()
+    while size > 0:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise socket.error("Livestatus connection closed by peer")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+class _RowParser(object):
+    """
+    Incremental parser of livestatus JSON output (list of lists), feed returns rows completed so far
+    """
+    _skip = re.compile(r'[\s,]*')
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._started = False
+        self._finished = False
+
+    def feed(self, data):
+        buf = self._buf + self._utf8.decode(data)
+        pos = 0
+        rows = list()
+        while not self._finished:
+            pos = self._skip.match(buf, pos).end()
+            if pos >= len(buf):
+                break
+            if not self._started:
+                if buf[pos] != '[':
+                    raise ValueError("Unexpected livestatus output at %r" % buf[pos:pos + 32])
+                self._started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                self._finished = True
+                pos += 1
+                break
+            try:
+                row, pos = self._decoder.raw_decode(buf, pos)
+            except ValueError:
+                break  # row not yet complete
+            rows.append(row)
+        self._buf = buf[pos:]
+        return rows
+
+    def close(self):
+        if self._buf.strip() or (self._started and not self._finished):
+            raise ValueError("Incomplete livestatus output")
+
+
+_row_types = dict()
+
+
+def _row_type(columns):
+    # rows are tuples sharing the column index of their class (one class per set of columns)
+    key = tuple(columns)
+    if key not in _row_types:
+        _row_types[key] = collections.namedtuple('Row', [str(c) for c in columns], rename=True)
+    return _row_types[key]
+
+
+def _prepare(request, keepalive=True):
+    # adds headers needed to run the request over a persistent connection (if not already present)
+    lines = [line.strip() for line in request.strip().split('\n') if line.strip()]
+    headers = set(line.split(':', 1)[0].strip() for line in lines[1:])
+    extra = [('OutputFormat', 'json'), ('ColumnHeaders', 'on'), ('ResponseHeader', 'fixed16')]
+    if keepalive:
+        extra.append(('KeepAlive', 'on'))
+    for header, value in extra:
+        if header not in headers:
+            lines.append('%s: %s' % (header, value))
+    return ('\n'.join(lines) + '\n\n').encode('utf-8')
+
+
+class LivestatusClient(object):
+    """
+    Livestatus client running queries over persistent connections (KeepAlive: on), response length is
+    taken from the fixed16 response header. Address is either path to the live status pipe or a tuple
+    (host, port) for remote connection, remote address is resolved only once. Idle connections are kept
+    in a pool (up to pool_size) and connections that failed are transparently re-established, forked
+    children (e.g. isolated metrics) open their own connections. Optionally, responses are cached in
+    nap.cache.FileCache shared with other processes, keyed by address and normalized request.
+    """
+    def __init__(self, address, timeout=None, pool_size=4, cache=None):
+        self.address = address
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.cache = cache
+        self._sockaddr = None
+        self._idle = list()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _resolve(self):
+        if self._sockaddr is None:
+            if isinstance(self.address, (tuple, list)) and len(self.address) == 2:
+                host_addr = socket.getaddrinfo(self.address[0], self.address[1], 0, socket.SOCK_STREAM,
+                                               socket.IPPROTO_TCP)
+                ip6 = [a for a in host_addr if a[0] == socket.AF_INET6]
+                family, _, _, _, sockaddr = (ip6 or host_addr)[0]
+                self._sockaddr = (family, sockaddr)
             else:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        else:
-            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        sock.connect(address)
-        if 'OutputFormat: json\nColumnHeaders: on\n' not in request:
-            request += '\nOutputFormat: json\nColumnHeaders: on\n'
-        sock.send(request)
-        sock.shutdown(socket.SHUT_WR)
-        rawdata = sock.makefile().read()
-        if not rawdata:
+                self._sockaddr = (socket.AF_UNIX, self.address)
+        return self._sockaddr
+
+    def _connect(self):
+        family, sockaddr = self._resolve()
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(sockaddr)
+        except (socket.error, socket.timeout):
+            sock.close()
+            self._sockaddr = None
+            raise
+        return sock
+
+    def _acquire(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # connections belong to the parent process
+                self._idle = list()
+                self._pid = os.getpid()
+            if self._idle:
+                return self._idle.pop(), True
+        return self._connect(), False
+
+    def _release(self, sock):
+        with self._lock:
+            if len(self._idle) < self.pool_size and self._pid == os.getpid():
+                self._idle.append(sock)
+                return
+        sock.close()
+
+    def _send(self, sock, payload):
+        sock.sendall(payload)
+        header = _recv_exactly(sock, 16)
+        return header[:3].decode(), int(header[4:15])
+
+    def _request(self, request):
+        # sends request, retrying once on a fresh connection if pooled connection failed,
+        # returns socket positioned at the start of the response body and its length
+        payload = _prepare(request)
+        sock, reused = self._acquire()
+        try:
+            code, length = self._send(sock, payload)
+        except (socket.error, socket.timeout, ValueError):
+            sock.close()
+            if not reused:
+                raise
+            sock = self._connect()
+            try:
+                code, length = self._send(sock, payload)
+            except BaseException:
+                sock.close()
+                raise
+        if code != '200':
+            try:
+                body = _recv_exactly(sock, length)
+            except BaseException:
+                sock.close()
+                raise
+            self._release(sock)
+            raise LivestatusError(code, body.decode('utf-8', 'replace').strip())
+        return sock, length
+
+    def raw_query(self, request, cache=None):
+        # returns raw (JSON) response body
+        if cache is None:
+            cache = self.cache
+        if cache:
+            key = '%r\n%s' % (self.address, _prepare(request).decode('utf-8'))
+            return cache.get_or_set(key, lambda: self.raw_query(request, cache=False))
+        sock, length = self._request(request)
+        try:
+            body = _recv_exactly(sock, length)
+        except BaseException:
+            sock.close()
+            raise
+        self._release(sock)
+        return body
+
+    def iter_query(self, request, chunk_size=65536, cache=None):
+        # yields rows (tuples with attribute access by column name) as they are read from the socket,
+        # connection is dropped if the iteration is not completed
+        if cache or (cache is None and self.cache):
+            parser = _RowParser()
+            rows = parser.feed(self.raw_query(request, cache=cache))
+            parser.close()
+            for row in rows[1:]:
+                yield _row_type(rows[0])(*row)
+            return
+        sock, remaining = self._request(request)
+        parser = _RowParser()
+        row_type = None
+        try:
+            while remaining > 0:
+                chunk = sock.recv(min(remaining, chunk_size))
+                if not chunk:
+                    raise socket.error("Livestatus connection closed by peer")
+                remaining -= len(chunk)
+                for row in parser.feed(chunk):
+                    if row_type is None:
+                        row_type = _row_type(row)
+                        continue
+                    yield row_type(*row)
+            parser.close()
+        except BaseException:
+            sock.close()
+            raise
+        self._release(sock)
+
+    def query(self, request, cache=None):
+        rawdata = self.raw_query(request, cache=cache)
+        if not rawdata.strip():
+            return []
+        data = json.loads(rawdata.decode('utf-8'))
+        if not data:
             return []
-        data = json.loads(rawdata)
         return [dict(zip(data[0], value)) for value in data[1:]]
-    finally:
-        if sock:
+
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = list()
+        for sock in idle:
             sock.close()
+
+
+_clients = dict()
+_clients_lock = threading.Lock()
+_now = getattr(time, 'monotonic', time.time)
+
+
+def client(address, timeout=None):
+    # shared client per address (and timeout), so that repeated queries re-use the same connections
+    key = (tuple(address) if isinstance(address, list) else address, timeout)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = LivestatusClient(address, timeout=timeout)
+        return _clients[key]
+
+
+# streaming variant of query, yields rows as tuples with attribute access by column name
+def iter_query(address, request, cache=None):
+    return client(address).iter_query(request, cache=cache)
+
+
+# Live status helper function - returns JSON object,
+# address is either path to the live status pipe or
+# a tuple (host, port) for remote connection,
+# optional cache (nap.cache.FileCache) is shared with other processes
+def query(address, request, cache=None):
+    return client(address).query(request, cache=cache)
+
+
+# rows returned by a site (each tagged with the site name under key 'site'), error is set if the site
+# failed or didn't answer in time
+SiteRows = collections.namedtuple('SiteRows', ['site', 'rows', 'error'])
+# merged rows of all sites that answered and errors of those that didn't (site name -> exception)
+MultiSiteResult = collections.namedtuple('MultiSiteResult', ['rows', 'errors'])
+
+
+def _sites(sites):
+    # sites are given as dict (site name -> address) or list of addresses (named by the address)
+    if isinstance(sites, dict):
+        return sorted(sites.items())
+    return [(a if not isinstance(a, (tuple, list)) else '%s:%s' % tuple(a), a) for a in sites]
+
+
+def iter_multisite_query(sites, request, timeout=10, cache=None):
+    # sends the same request to all sites concurrently and yields SiteRows as the sites answer,
+    # sites that fail or don't answer within timeout seconds are yielded (last) with the error
+    results = queue.Queue()
+
+    def worker(site, address):
+        try:
+            rows = client(address, timeout).query(request, cache=cache)
+        except Exception as e:
+            results.put(SiteRows(site, [], e))
+            return
+        for row in rows:
+            row['site'] = site
+        results.put(SiteRows(site, rows, None))
+
+    pending = set()
+    for site, address in _sites(sites):
+        pending.add(site)
+        t = threading.Thread(target=worker, args=(site, address))
+        t.daemon = True
+        t.start()
+    expires = _now() + timeout
+    while pending:
+        try:
+            result = results.get(timeout=max(expires - _now(), 0))
+        except queue.Empty:
+            break
+        pending.discard(result.site)
+        yield result
+    for site in sorted(pending):
+        # still running queries are left to time out on their own (socket timeout)
+        yield SiteRows(site, [], socket.timeout("Site %s didn't answer within %ss" % (site, timeout)))
+
+
+def multisite_query(sites, request, timeout=10, cache=None):
+    # same as query, run on all sites concurrently, returns MultiSiteResult with rows of all sites
+    # that answered (tagged by site) and errors of the others
+    rows = list()
+    errors = dict()
+    for result in iter_multisite_query(sites, request, timeout=timeout, cache=cache):
+        if result.error is not None:
+            errors[result.site] = result.error
+        rows.extend(result.rows)
+    return MultiSiteResult(rows, errors)
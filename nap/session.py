@@ -0,0 +1,232 @@
+import logging
+import os
+import select
+import threading
+import uuid
+
+from nap import core
+
+log = logging.getLogger()
+
+# Commands run via long-lived shell sessions instead of a new process each, every command is followed
+# by printf of a random sentinel and its exit code, output is read until the sentinel. The sentinel is
+# printed from two parts, so that the command echoed back by a terminal never matches it. Commands read
+# stdin from /dev/null (stdin of the session carries the commands). Sessions whose command timed out are
+# killed and replaced, state (working directory, environment) set by a command persists in its session.
+
+
+def _quote(args):
+    if not isinstance(args, (list, tuple)):
+        return args
+    try:
+        from shlex import quote
+    except ImportError:
+        from pipes import quote
+    return ' '.join(quote(arg) for arg in args)
+
+
+def _script(command, sentinel):
+    half = len(sentinel) // 2
+    return "{ %s\n} </dev/null 2>&1; printf '%%s%%s:%%d\\n' %s %s $?\n" % \
+        (command, sentinel[:half], sentinel[half:])
+
+
+class ShellSession(object):
+    """
+    Long-lived shell (/bin/sh by default) running commands one at a time, setup commands (environment,
+    working directory) are run once when the session starts. Session runs in its own process group.
+    """
+    def __init__(self, shell=('/bin/sh',), setup=None, chunk_size=65536):
+        subprocess = core._import_subprocess()
+        self.chunk_size = chunk_size
+        self.proc = subprocess.Popen(list(shell), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+        self.alive = True
+        for command in setup or []:
+            self.run(command, timeout=60)
+
+    def _send(self, data):
+        os.write(self.proc.stdin.fileno(), data.encode('utf-8'))
+
+    def run(self, args, timeout=3600):
+        # runs command (string or argument list), returns tuple (return code, output)
+        if not self.alive:
+            raise ValueError("Session is closed")
+        deadline = core._current_deadline.get()
+        if deadline:
+            timeout = deadline.clip(timeout)
+            deadline.add_process(self.proc.pid)
+        expires = None if timeout is None else core._now() + timeout
+        marker = uuid.uuid4().hex
+        sentinel = marker.encode() + b':'
+        fd = self.proc.stdout.fileno()
+        chunks = bytearray()
+        pos = -1
+        try:
+            self._send(_script(_quote(args), marker))
+            while True:
+                remaining = None if expires is None else expires - core._now()
+                if remaining is not None and remaining <= 0:
+                    raise core._timeout_expired(args, timeout)
+                if not select.select([fd], [], [], remaining)[0]:
+                    continue
+                chunk = os.read(fd, self.chunk_size)
+                if not chunk:
+                    # command exited the shell
+                    self.close()
+                    return self.proc.returncode, bytes(chunks)
+                start = max(len(chunks) - len(sentinel), 0)
+                chunks.extend(chunk)
+                if pos < 0:
+                    pos = chunks.find(sentinel, start)
+                end = chunks.find(b'\n', pos) if pos >= 0 else -1
+                if end >= 0:
+                    return int(chunks[pos + len(sentinel):end]), bytes(chunks[:pos])
+        except BaseException:
+            self.kill()
+            raise
+        finally:
+            if deadline:
+                deadline.remove_process(self.proc.pid)
+
+    def kill(self):
+        core._kill_process_group(self.proc.pid)
+        self.close()
+
+    def close(self):
+        if self.alive:
+            self.alive = False
+            for f in (self.proc.stdin, self.proc.stdout):
+                try:
+                    f.close()
+                except (IOError, OSError):
+                    pass
+            self.proc.wait()
+
+
+class PexpectSession(object):
+    """
+    Long-lived interactive session (e.g. ssh host) driven by pexpect, setup commands are run once after
+    it's spawned (login, environment); prompts and echo are turned off, so that output of commands is
+    kept as printed.
+    """
+    def __init__(self, command='/bin/sh', setup=None, logfile=None):
+        import pexpect
+        self.child = pexpect.spawn(command, env=os.environ, logfile=logfile, echo=False)
+        self.alive = True
+        for command in ["PS1=''; PS2=''; stty -echo"] + list(setup or []):
+            self.run(command, timeout=60)
+
+    def run(self, args, timeout=3600):
+        import re
+        import pexpect
+        if not self.alive:
+            raise ValueError("Session is closed")
+        deadline = core._current_deadline.get()
+        if deadline:
+            timeout = deadline.clip(timeout)
+            deadline.add_process(self.child.pid)
+        marker = uuid.uuid4().hex
+        try:
+            self.child.send(_script(_quote(args), marker))
+            try:
+                self.child.expect(re.escape(marker) + r':(\d+)\r?\n', timeout=timeout)
+            except pexpect.TIMEOUT:
+                raise core._timeout_expired(args, timeout)
+            except pexpect.EOF:
+                self.close()
+                return self.child.exitstatus, self.child.before.replace(b'\r\n', b'\n')
+            return int(self.child.match.group(1)), self.child.before.replace(b'\r\n', b'\n')
+        except BaseException:
+            self.kill()
+            raise
+        finally:
+            if deadline:
+                deadline.remove_process(self.child.pid)
+
+    def kill(self):
+        core._kill_process_group(self.child.pid)
+        self.close()
+
+    def close(self):
+        if self.alive:
+            self.alive = False
+            self.child.close(force=True)
+
+
+class SessionPool(object):
+    """
+    Pool of up to size sessions (created by factory as needed) shared by threads running metrics,
+    run blocks while all sessions are busy. Sessions that died or timed out are replaced. Forked
+    children (e.g. isolated metrics) start their own sessions.
+    """
+    def __init__(self, size=1, factory=ShellSession, **kwargs):
+        self.size = size
+        self.factory = factory
+        self.kwargs = kwargs
+        self._idle = list()
+        self._count = 0
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _acquire(self):
+        with self._cond:
+            if self._pid != os.getpid():
+                # sessions belong to the parent process
+                self._idle = list()
+                self._count = 0
+                self._pid = os.getpid()
+            while not self._idle and self._count >= self.size:
+                self._cond.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._count += 1
+        try:
+            return self.factory(**self.kwargs)
+        except BaseException:
+            self._release(None)
+            raise
+
+    def _release(self, session):
+        with self._cond:
+            if session is not None and session.alive and self._pid == os.getpid():
+                self._idle.append(session)
+            else:
+                self._count -= 1
+            self._cond.notify()
+
+    def run(self, args, timeout=3600):
+        # runs command in the first available session, returns tuple (return code, output)
+        session = self._acquire()
+        try:
+            log.debug("    Session command %s starting" % (args,))
+            return session.run(args, timeout=timeout)
+        finally:
+            self._release(session)
+
+    def close(self):
+        with self._cond:
+            idle = self._idle
+            self._idle = list()
+            self._count -= len(idle)
+        for session in idle:
+            session.close()
+
+
+_default_pool = None
+_default_lock = threading.Lock()
+
+
+def default_pool():
+    # pool of shell sessions used by sub_process(mode='session') if no pool is given
+    global _default_pool
+    with _default_lock:
+        if _default_pool is None:
+            _default_pool = SessionPool(size=4)
+        return _default_pool
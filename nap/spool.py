@@ -0,0 +1,164 @@
+import errno
+import fcntl
+import logging
+import os
+import tempfile
+import time
+
+from nap.cache import secure_directory
+
+log = logging.getLogger()
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class Spool(object):
+    """
+    Bounded append-only on-disk spool of external commands (one command per line). Each process
+    appends to its own open segment (<time>-<pid>-<n>.open), which is sealed (renamed to .spool)
+    once it reaches segment_bytes or on close. Once the spool exceeds max_bytes, oldest sealed
+    segments are dropped. Replay writes sealed segments (and segments left open by processes that
+    are gone) oldest first to the command pipe, only one process replays at a time. Directory must be
+    owned by the user with mode 0700 (it's created so if it doesn't exist).
+    """
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024, segment_bytes=1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self._fd = None
+        self._segment = None
+        self._size = 0
+        self._count = 0
+        # spooled commands are replayed to the command pipe as they are, no other user may write them
+        secure_directory(self.directory)
+
+    def _seal(self):
+        if self._fd is None:
+            return
+        os.close(self._fd)
+        if self._size:
+            os.rename(self._segment, self._segment[:-len('.open')] + '.spool')
+        else:  # fully replayed
+            os.unlink(self._segment)
+        self._fd = None
+        self._segment = None
+        self._size = 0
+
+    def _rotate(self):
+        self._seal()
+        self._count += 1
+        name = '%017d-%d-%d.open' % (int(time.time() * 1000000), os.getpid(), self._count)
+        self._segment = os.path.join(self.directory, name)
+        self._fd = os.open(self._segment, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self._size = 0
+
+    def append(self, lines):
+        if self._fd is None or self._size >= self.segment_bytes:
+            self._rotate()
+        data = b''.join(lines)
+        while data:
+            written = os.write(self._fd, data)
+            data = data[written:]
+            self._size += written
+        self._enforce_limit()
+
+    def segments(self):
+        # segments ready for replay, oldest first
+        segments = list()
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith('.spool'):
+                segments.append(os.path.join(self.directory, name))
+            elif name.endswith('.open'):
+                try:
+                    pid = int(name.split('-')[1])
+                except (IndexError, ValueError):
+                    continue
+                if pid != os.getpid() and not _pid_alive(pid):
+                    segments.append(os.path.join(self.directory, name))
+        return segments
+
+    def _enforce_limit(self):
+        segments = list()
+        total = 0
+        for path in self.segments():
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue
+            segments.append((path, size))
+            total += size
+        total += self._size
+        for path, size in segments:
+            if total <= self.max_bytes:
+                break
+            log.warning("Spool (%s) exceeded %d bytes, dropping %s" % (self.directory, self.max_bytes, path))
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+    def replay(self, cmd_pipe):
+        # writes spooled commands via cmd_pipe (nap.core.CommandPipe), returns True if spool was drained;
+        # commands in the segment this process appends to are replayed last (segment is kept open)
+        if not self._size and not self.segments():
+            return True
+        with open(os.path.join(self.directory, 'replay.lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                return False  # other process is replaying
+            try:
+                for path in self.segments():
+                    try:
+                        with open(path, 'rb') as f:
+                            lines = f.read().splitlines(True)
+                    except (IOError, OSError):
+                        continue
+                    written = cmd_pipe.write_lines(lines)
+                    if written < len(lines):
+                        self._rewrite(path, lines[written:])
+                        return False
+                    os.unlink(path)
+                    log.debug("Replayed %d spooled commands from %s" % (len(lines), path))
+                return self._replay_open(cmd_pipe)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _replay_open(self, cmd_pipe):
+        if not self._size:
+            return True
+        with open(self._segment, 'rb') as f:
+            lines = f.read().splitlines(True)
+        written = cmd_pipe.write_lines(lines)
+        if written < len(lines):
+            # segment is replaced by the commands left, so that it's never left partially replayed
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(b''.join(lines[written:]))
+            os.rename(tmp_path, self._segment)
+            os.close(self._fd)
+            self._fd = os.open(self._segment, os.O_WRONLY | os.O_APPEND)
+            self._size = os.fstat(self._fd).st_size
+            return False
+        os.ftruncate(self._fd, 0)
+        self._size = 0
+        log.debug("Replayed %d spooled commands from %s" % (len(lines), self._segment))
+        return True
+
+    def _rewrite(self, path, lines):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b''.join(lines))
+        os.rename(tmp_path, path if path.endswith('.spool') else path[:-len('.open')] + '.spool')
+        if not path.endswith('.spool'):
+            os.unlink(path)
+
+    def close(self):
+        self._seal()
@@ -0,0 +1,195 @@
+import errno
+import json
+import logging
+import os
+import socket
+import stat
+import sys
+
+import nap
+
+log = logging.getLogger()
+
+# Plugin executed by a long-lived worker process, avoiding interpreter start-up for every check.
+# Requests are plugin arguments (JSON list terminated by newline), responses are a header line
+# "<exit code> <length>\n" followed by <length> bytes of plugin output. Any number of requests can be
+# sent over the same connection (or stream). Requests are served one at a time, several workers can
+# be started to serve checks concurrently. Nagios runs the client shim in place of the plugin:
+#   python -m nap.worker /path/to/worker.sock -H host -t 60 ...
+# nap.core is imported only by the worker, so that the client shim starts as fast as possible.
+
+
+def _encode_response(code, output):
+    data = output.encode('utf-8') if not isinstance(output, bytes) else output
+    return ('%d %d\n' % (code, len(data))).encode() + data
+
+
+def _read_exactly(rfile, size):
+    chunks = list()
+    while size > 0:
+        chunk = rfile.read(size)
+        if not chunk:
+            raise ValueError("Incomplete response from plugin worker")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _route_output():
+    # output (including argparse errors and --help) is dispatched to the stream bound by execute
+    import nap.core
+    saved = sys.stdout, sys.stderr
+    if not isinstance(sys.stdout, nap.core._OutputRouter):
+        sys.stdout = nap.core._OutputRouter(saved[0])
+        sys.stderr = nap.core._OutputRouter(saved[1])
+    return saved
+
+
+def execute(plugin, argv):
+    # executes plugin with the given arguments, returns exit code and output (as seen from Plugin.run)
+    import nap.core
+    try:
+        from StringIO import StringIO
+    except ImportError:
+        from io import StringIO
+    output = StringIO()
+    saved = _route_output()
+    binding = nap.core._bound_stream.get()
+    nap.core._bound_stream.set(output)
+    try:
+        code = plugin.execute(argv, stdout=output)
+    except SystemExit as e:  # --help, --version or invalid arguments
+        code = e.code if isinstance(e.code, int) else (nap.OK if e.code is None else nap.UNKNOWN)
+    except Exception as e:
+        log.exception("Plugin failed to execute with %r" % (argv,))
+        output.write("UNKNOWN - Plugin worker failed to execute plugin (%s)\n" % e)
+        code = nap.UNKNOWN
+    finally:
+        nap.core._bound_stream.set(binding)
+        sys.stdout, sys.stderr = saved
+    return code, output.getvalue()
+
+
+def serve_stream(plugin, rfile, wfile, max_requests=None):
+    # serves requests read from rfile until end of stream (or max_requests), returns number served
+    served = 0
+    while max_requests is None or served < max_requests:
+        line = rfile.readline()
+        if not line:
+            break
+        if not line.strip():
+            continue
+        try:
+            argv = json.loads(line.decode('utf-8'))
+            if not isinstance(argv, list):
+                raise ValueError("expected list of arguments")
+        except ValueError as e:
+            code, output = nap.UNKNOWN, "UNKNOWN - Invalid request to plugin worker (%s)\n" % e
+        else:
+            code, output = execute(plugin, [str(arg) for arg in argv])
+        wfile.write(_encode_response(code, output))
+        wfile.flush()
+        served += 1
+    return served
+
+
+def _remove_stale_socket(address):
+    # removes socket left over by a worker that is gone; anything else at address (a file, a socket
+    # of a worker still listening) is kept and the worker refuses to start
+    try:
+        st = os.lstat(address)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return
+        raise
+    if not stat.S_ISSOCK(st.st_mode):
+        raise OSError(errno.EEXIST, "Refusing to start plugin worker, %s exists and is not a socket" % address)
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(address)
+    except socket.error as e:
+        if e.errno != errno.ECONNREFUSED:
+            raise
+        os.unlink(address)
+        return
+    finally:
+        probe.close()
+    raise OSError(errno.EADDRINUSE, "Refusing to start plugin worker, another worker listens at %s" % address)
+
+
+def serve(plugin, address=None, max_requests=None, backlog=64):
+    # serves requests sent to unix socket at address (stdin/stdout if address is not given),
+    # returns once max_requests were served (allowing the worker to be recycled)
+    if not address:
+        stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+        stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+        return serve_stream(plugin, stdin, stdout, max_requests)
+    _remove_stale_socket(address)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    served = 0
+    try:
+        sock.bind(address)
+        sock.listen(backlog)
+        while max_requests is None or served < max_requests:
+            conn, _ = sock.accept()
+            rfile = conn.makefile('rb')
+            wfile = conn.makefile('wb')
+            try:
+                served += serve_stream(plugin, rfile, wfile,
+                                       None if max_requests is None else max_requests - served)
+            except (socket.error, IOError) as e:
+                log.warning("Plugin worker connection failed (%s)" % e)
+            finally:
+                rfile.close()
+                try:
+                    wfile.close()
+                except (socket.error, IOError):
+                    pass
+                conn.close()
+    finally:
+        sock.close()
+        try:
+            os.unlink(address)
+        except OSError:
+            pass
+    return served
+
+
+def request(address, argv, timeout=None):
+    # sends plugin arguments to the worker listening at address, returns exit code and output
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(address)
+        sock.sendall((json.dumps(list(argv)) + '\n').encode('utf-8'))
+        rfile = sock.makefile('rb')
+        try:
+            header = rfile.readline().split()
+            if len(header) != 2:
+                raise ValueError("Invalid response from plugin worker")
+            output = _read_exactly(rfile, int(header[1]))
+        finally:
+            rfile.close()
+    finally:
+        sock.close()
+    return int(header[0]), output.decode('utf-8')
+
+
+def main(argv=None):
+    # client shim executed by Nagios: python -m nap.worker <socket> [plugin arguments]
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
+        sys.stdout.write("UNKNOWN - usage: python -m nap.worker SOCKET [PLUGIN ARGUMENTS]\n")
+        return nap.UNKNOWN
+    try:
+        code, output = request(argv[0], argv[1:])
+    except (socket.error, ValueError) as e:
+        sys.stdout.write("UNKNOWN - Failed to contact plugin worker at %s (%s)\n" % (argv[0], e))
+        return nap.UNKNOWN
+    sys.stdout.write(output)
+    sys.stdout.flush()
+    return code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,4 @@
+import sys
+
+# asyncio support (nap.aio) and its tests are python 3 only
+collect_ignore = ['test_aio.py'] if sys.version_info[0] < 3 else []
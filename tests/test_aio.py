@@ -0,0 +1,95 @@
+import asyncio
+import subprocess
+import sys
+import time
+import unittest
+
+import nap
+import nap.aio
+import nap.core
+
+
+class TestAIO(unittest.TestCase):
+    def setUp(self):
+        # PluginIO redirects sys.stdout/sys.stderr, streams are restored after every test
+        self.streams = sys.stdout, sys.stderr
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self.streams
+
+    def test_async_metrics(self):
+        app = nap.core.Plugin()
+
+        @app.metric(passive=True)
+        async def test_m1(args, io):
+            rc, out = await nap.aio.sub_process("sleep 1; echo m1", shell=True, timeout=10)
+            print(out.decode().strip())
+            self.assertEqual(io.getvalue(), "m1\n")
+            io.set_status(nap.OK, "m1 ok")
+
+        @app.metric(passive=True)
+        async def test_m2(args, io):
+            rc, out = await nap.aio.sub_process(["sleep", "1"], timeout=10)
+            print("m2")
+            self.assertEqual(io.getvalue(), "m2\n")
+            io.set_status(nap.OK if rc == 0 else nap.CRITICAL, "m2 done")
+
+        @app.metric(depends_on=[test_m1, test_m2])
+        def test_all(args, io):
+            io.set_status(max(e[1] for e in app.metric_results()), "all done")
+
+        start = time.time()
+        app.run(['--dry-run'])
+        self.assertTrue(time.time() - start < 1.9)
+        self.assertEqual([e[:2] for e in app.metric_results()],
+                         [('test_m1', nap.OK), ('test_m2', nap.OK), ('test_all', nap.OK)])
+
+    def test_async_output(self):
+        # output of coroutines interleaving on the loop is captured per metric
+        app = nap.core.Plugin()
+        details = dict()
+
+        @app.metric(passive=True)
+        async def a(args, io):
+            await asyncio.sleep(0.1)
+            print("from a")
+            await asyncio.sleep(0.2)
+            details['a'] = io.getvalue()
+            io.set_status(nap.OK, "a")
+
+        @app.metric()
+        async def b(args, io):
+            print("from b")
+            await asyncio.sleep(0.2)
+            print("b again")
+            details['b'] = io.getvalue()
+            io.set_status(nap.OK, "b")
+
+        app.run(['--dry-run'])
+        self.assertEqual(details, {'a': "from a\n", 'b': "from b\nb again\n"})
+
+    def test_async_subprocess(self):
+        loop = asyncio.new_event_loop()
+        try:
+            rc, out = loop.run_until_complete(nap.aio.sub_process("/bin/echo Yes", shell=True, timeout=20))
+            self.assertEqual(rc, 0)
+            self.assertTrue(b'Yes' in out)
+            self.assertRaises(subprocess.TimeoutExpired, loop.run_until_complete,
+                              nap.aio.sub_process("/bin/sleep 10", shell=True, timeout=1))
+        finally:
+            loop.close()
+
+    def test_isolate_coroutine(self):
+        # coroutine metrics run in the event loop, they can't be isolated in a forked child
+        app = nap.core.Plugin()
+
+        async def test_m1(args, io):
+            io.set_status(nap.OK, "m1 ok")
+
+        with self.assertRaises(ValueError):
+            app.metric(isolate=True)(test_m1)
+        self.assertEqual(app.sequence, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import json
+import shutil
+import tempfile
+import unittest
+
+try:
+    import messaging  # noqa: F401
+    import nap.dq
+except ImportError:
+    nap = None
+
+
+@unittest.skipUnless(nap, "python-messaging not available")
+class TestDQ(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_enqueue_many(self):
+        batches = list()
+        writer = nap.dq.QueueWriter(self.tmp_dir, '/topic/test', report=lambda n, t: batches.append(n))
+        events = [{'value': i} for i in range(250)]
+        self.assertEqual(writer.enqueue_many(events, batch_size=100), 250)
+        self.assertEqual(batches, [100, 100, 50])
+
+        from messaging.queue.dqs import DQS
+        mq = DQS(path=self.tmp_dir)
+        self.assertEqual(mq.count(), 250)
+        name = mq.first()
+        mq.lock(name)
+        msg = mq.get_message(name)
+        self.assertEqual(msg.header['destination'], '/topic/test')
+        self.assertTrue('timestamp' in json.loads(msg.body))
+
+
+if __name__ == '__main__':
+    unittest.main()
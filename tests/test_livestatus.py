@@ -0,0 +1,190 @@
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import nap.cache
+import nap.livestatus
+
+
+class FakeLivestatus(object):
+    """
+    Minimal livestatus server listening on a unix socket, answers every request with the given rows
+    and supports KeepAlive and fixed16 response headers
+    """
+    def __init__(self, path, rows, delay=0):
+        self.path = path
+        self.rows = rows
+        self.delay = delay
+        self.connections = 0
+        self.requests = list()
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(path)
+        self._sock.listen(16)
+        t = threading.Thread(target=self._serve)
+        t.daemon = True
+        t.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except (socket.error, OSError):
+                return
+            self.connections += 1
+            t = threading.Thread(target=self._handle, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def _handle(self, conn):
+        f = conn.makefile('rb')
+        try:
+            while True:
+                lines = list()
+                while True:
+                    line = f.readline()
+                    if not line:
+                        return
+                    if not line.strip():
+                        break
+                    lines.append(line.decode().strip())
+                self.requests.append(lines)
+                time.sleep(self.delay)
+                headers = dict(line.split(': ', 1) for line in lines[1:])
+                if lines[0].startswith('GET unknown'):
+                    code, body = 404, b'Invalid GET request, no such table\n'
+                else:
+                    body = json.dumps(self.rows).encode()
+                    code = 200
+                if headers.get('ResponseHeader') == 'fixed16':
+                    conn.sendall(('%3d %11d\n' % (code, len(body))).encode())
+                conn.sendall(body)
+                if headers.get('KeepAlive') != 'on':
+                    return
+        except (socket.error, OSError):
+            pass  # client dropped the connection
+        finally:
+            f.close()
+            conn.close()
+
+    def close(self):
+        self._sock.close()
+
+
+class TestLivestatus(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'live')
+        self.server = FakeLivestatus(self.path, [['name', 'state'], ['host1', 0], ['host2', 1]])
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_keepalive(self):
+        with nap.livestatus.LivestatusClient(self.path) as client:
+            for _ in range(50):
+                rows = client.query("GET hosts\nColumns: name state\n")
+                self.assertEqual(rows, [{'name': 'host1', 'state': 0}, {'name': 'host2', 'state': 1}])
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(len(self.server.requests), 50)
+        self.assertTrue('KeepAlive: on' in self.server.requests[0])
+        self.assertTrue('ResponseHeader: fixed16' in self.server.requests[0])
+
+    def test_reconnect(self):
+        client = nap.livestatus.LivestatusClient(self.path)
+        client.query("GET hosts")
+        # drop pooled connection behind client's back
+        client._idle[0].shutdown(socket.SHUT_RDWR)
+        self.assertEqual(len(client.query("GET hosts")), 2)
+        self.assertEqual(self.server.connections, 2)
+        self.assertRaises(nap.livestatus.LivestatusError, client.query, "GET unknown")
+        client.close()
+
+    def test_fork(self):
+        client = nap.livestatus.LivestatusClient(self.path)
+        client.query("GET hosts")
+        pid = os.fork()
+        if not pid:
+            # child must not talk over the connection pooled by the parent
+            os._exit(0 if len(client.query("GET hosts")) == 2 else 1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(len(client.query("GET hosts")), 2)
+        self.assertEqual(self.server.connections, 2)
+        client.close()
+
+    def test_iter_query(self):
+        self.server.rows = [['name', 'state']] + [['host%d \u2758' % i, i % 4] for i in range(20000)]
+        with nap.livestatus.LivestatusClient(self.path) as client:
+            rows = list(client.iter_query("GET hosts\nColumns: name state", chunk_size=1000))
+            self.assertEqual(len(rows), 20000)
+            self.assertEqual(rows[7].name, 'host7 \u2758')
+            self.assertEqual(rows[7], ('host7 \u2758', 3))
+            self.assertTrue(type(rows[0]) is type(rows[1]))
+            # abandoned iteration drops the connection, next query connects again
+            it = client.iter_query("GET hosts")
+            next(it)
+            it.close()
+            self.assertEqual(len(list(client.iter_query("GET hosts"))), 20000)
+            self.assertEqual(client.query("GET hosts")[3], {'name': 'host3 \u2758', 'state': 3})
+        self.assertEqual(self.server.connections, 2)
+
+    def test_row_parser(self):
+        parser = nap.livestatus._RowParser()
+        data = b'[["name","state"],\n["a",0],\n["b[]",1]]\n'
+        rows = list()
+        for i in range(len(data)):
+            rows.extend(parser.feed(data[i:i + 1]))
+        parser.close()
+        self.assertEqual(rows, [["name", "state"], ["a", 0], ["b[]", 1]])
+
+    def test_cache(self):
+        cache = nap.cache.FileCache(os.path.join(self.tmp_dir, 'cache'), ttl=60, max_entries=2)
+        for _ in range(5):
+            rows = nap.livestatus.query(self.path, "GET hosts\nColumns: name state\n", cache=cache)
+            self.assertEqual(rows[1], {'name': 'host2', 'state': 1})
+        # normalized request hits the same entry
+        self.assertEqual(len(list(nap.livestatus.iter_query(self.path, " GET hosts \nColumns: name state",
+                                                            cache=cache))), 2)
+        self.assertEqual(len(self.server.requests), 1)
+        nap.livestatus.query(self.path, "GET services", cache=cache)
+        nap.livestatus.query(self.path, "GET contacts", cache=cache)
+        self.assertEqual(len([f for f in os.listdir(cache.directory) if f.endswith('.entry')]), 2)
+        self.assertEqual(len(self.server.requests), 3)
+        cache.ttl = 0
+        nap.livestatus.query(self.path, "GET contacts", cache=cache)
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_query(self):
+        for _ in range(5):
+            self.assertEqual(len(nap.livestatus.query(self.path, "GET hosts")), 2)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_multisite_query(self):
+        sites = {'site1': self.path, 'missing': os.path.join(self.tmp_dir, 'missing')}
+        for name in ('site2', 'slow'):
+            sites[name] = os.path.join(self.tmp_dir, name)
+        servers = [FakeLivestatus(sites['site2'], [['name', 'state'], ['host3', 2]]),
+                   FakeLivestatus(sites['slow'], [['name', 'state'], ['host4', 0]], delay=5)]
+        try:
+            start = time.time()
+            result = nap.livestatus.multisite_query(sites, "GET hosts\nColumns: name state", timeout=1)
+            self.assertTrue(time.time() - start < 2)
+            self.assertEqual(sorted((row['site'], row['name']) for row in result.rows),
+                             [('site1', 'host1'), ('site1', 'host2'), ('site2', 'host3')])
+            self.assertEqual(sorted(result.errors.keys()), ['missing', 'slow'])
+            self.assertTrue(isinstance(result.errors['slow'], socket.timeout))
+
+            answered = [r.site for r in nap.livestatus.iter_multisite_query([self.path, sites['site2']], "GET hosts")]
+            self.assertEqual(sorted(answered), sorted([self.path, sites['site2']]))
+        finally:
+            for server in servers:
+                server.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,20 @@
 from __future__ import print_function
 import unittest
+import errno
+import fcntl
 import logging
+import os
+import re
+import shutil
 import sys
+import tempfile
+import threading
+import time
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 # complex subprocess import
 SUBPROCESS_TIMEOUT = False
@@ -19,7 +32,10 @@ except ImportError:
         SUBPROCESS_TIMEOUT = False
         import subprocess
 
+import nap
+import nap.cache
 import nap.core
+import nap.spool
 
 log = logging.getLogger("wnfm")
 log.setLevel(logging.INFO)
@@ -34,6 +50,13 @@ log.addHandler(fh)
 
 
 class TestNAP(unittest.TestCase):
+    def setUp(self):
+        # PluginIO redirects sys.stdout/sys.stderr, streams are restored after every test
+        self.streams = sys.stdout, sys.stderr
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self.streams
+
     def test_basics(self):
         app = nap.core.Plugin()
         app.add_argument("--test", help="additional argument", default="yes")
@@ -117,7 +140,765 @@ class TestNAP(unittest.TestCase):
 
         self.assertTrue('PROCESS_SERVICE_CHECK_RESULT;localhost;UnitPlugin;0;OK - summary line | cpu=0.24;;;; '
                         '\\nSample two line output\\nfrom unit test\\n' in io.plugin_passive_out())
-        sys.stdout = nap.core.sys_stdout
+
+    def test_parallel(self):
+        app = nap.core.Plugin()
+        finished = []
+
+        @app.metric(passive=True)
+        def test_m1(args, io):
+            time.sleep(1)
+            print("output from m1")
+            finished.append('test_m1')
+            io.set_status(nap.OK, "m1 ok")
+
+        @app.metric(passive=True)
+        def test_m2(args, io):
+            time.sleep(1)
+            print("output from m2")
+            finished.append('test_m2')
+            io.set_status(nap.OK, "m2 ok")
+
+        @app.metric(seq=1, depends_on=[test_m1, 'test_m2'])
+        def test_all(args, io):
+            self.assertEqual(sorted(finished), ['test_m1', 'test_m2'])
+            self.assertEqual([e[0] for e in app.metric_results()], ['test_m1', 'test_m2'])
+            print("output from all")
+            self.assertEqual(io.getvalue(), "output from all\n")
+            io.set_status(nap.OK, "all ok")
+
+        start = time.time()
+        app.run(['--dry-run', '-j', '4'])
+        self.assertTrue(time.time() - start < 1.9)
+        self.assertEqual([e[0] for e in app.metric_results()], ['test_all', 'test_m1', 'test_m2'])
+        self.assertEqual(app.metric_results()[0][1], nap.OK)
+
+    def test_partial_order(self):
+        app = nap.core.Plugin()
+
+        @app.metric(depends_on=['test_b'])
+        def test_a(args, io):
+            pass
+
+        @app.metric(depends_on=['test_a'])
+        def test_b(args, io):
+            pass
+
+        self.assertRaises(ValueError, app._partial_order)
+
+    def test_bounded_output(self):
+        io = nap.core.PluginIO(metric_name="UnitPlugin", hostname="localhost", command_pipe="/dev/null",
+                               dry_run=True, max_output=1000, output_head=100)
+        io.set_status(nap.OK, "summary line")
+        io.write("first | line\n")
+        for i in range(100000):
+            io.write("line %d\n" % i)
+        value = io.getvalue()
+        self.assertTrue(value.startswith("first \\u2758 line\nline 0\n"))
+        self.assertTrue(value.endswith("line 99999\n"))
+        self.assertTrue("characters of output truncated" in value)
+        self.assertTrue(len(value) < 1100)
+        self.assertTrue(io.plugin_passive_out().endswith(";0;OK - summary line\\n" + value.replace("\n", "\\n")))
+        io.seek(0)
+        io.truncate()
+        self.assertEqual(io.getvalue(), "")
+
+    def test_perf_data(self):
+        io = nap.core.PluginIO(metric_name="UnitPlugin", hostname="localhost",
+                               command_pipe="/dev/null", dry_run=True)
+        io.add_perf_data("cpu", 0.24)
+        io.add_perf_data_many({"mem": 0.87}, uom="%")
+        io.add_perf_data_many(["eth0", "eth1"], (10, 20), uom="B", vmin=0)
+        io.add_perf_data_many([{"label": "disk", "value": 5, "crit": 90}])
+        io.close()
+        self.assertEqual(io._perf_container[1], nap.core.PerfData("mem", 0.87, "%", "", "", "", ""))
+        self.assertEqual(nap.core.format_perf_data(io._perf_container),
+                         "cpu=0.24;;;; mem=0.87%;;;; eth0=10B;;;0; eth1=20B;;;0; disk=5;;90;; ")
+        self.assertEqual(nap.core.format_perf_data([["cpu", 1, "", "", "", "", ""]], "|"), "cpu=1;;;;|")
+
+    def test_command_pipe(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fifo = os.path.join(tmp_dir, 'nagios.cmd')
+            os.mkfifo(fifo)
+            received = []
+
+            def reader():
+                with open(fifo, 'rb') as f:
+                    received.append(f.read())
+
+            t = threading.Thread(target=reader)
+            t.start()
+            cmd_pipe = nap.core.CommandPipe(fifo, max_buffer=10000)
+            for i in range(1000):
+                io = nap.core.PluginIO(metric_name="m%d" % i, hostname="localhost",
+                                       command_pipe=fifo, pipe_writer=cmd_pipe)
+                io.batch_passive_out("localhost", "m%d" % i, nap.OK, "summary %d" % i, "details\n")
+                io.close()
+            cmd_pipe.close()
+            t.join(10)
+            lines = received[0].decode().splitlines()
+            self.assertEqual(len(lines), 1000)
+            self.assertTrue(lines[999].endswith("PROCESS_SERVICE_CHECK_RESULT;localhost;m999;0;summary 999\\n"
+                                                "details\\n"))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_command_pipe_flush_interval(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fifo = os.path.join(tmp_dir, 'nagios.cmd')
+            os.mkfifo(fifo)
+            fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+            try:
+                cmd_pipe = nap.core.CommandPipe(fifo, flush_interval=0.2)
+                cmd_pipe.write("[1] PROCESS_SERVICE_CHECK_RESULT;localhost;m1;0;summary")
+                self.assertEqual(os.read(fd, 1024), b'')  # buffered, pipe not opened yet
+                # flushed without further writes or close, while the plugin keeps running
+                received = b''
+                for _ in range(50):
+                    time.sleep(0.1)
+                    try:
+                        received += os.read(fd, 1024)
+                    except OSError:  # opened, nothing written yet
+                        continue
+                    if received:
+                        break
+                self.assertEqual(received, b"[1] PROCESS_SERVICE_CHECK_RESULT;localhost;m1;0;summary\n")
+                cmd_pipe.close()
+            finally:
+                os.close(fd)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_check_result_path(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            writer = nap.core.CheckResultWriter(tmp_dir, max_results=400)
+            for i in range(1000):
+                writer.write("[1481713137] PROCESS_SERVICE_CHECK_RESULT;host%d;m%d;%d;summary %d\\ndetails\\n\n"
+                             % (i, i, i % 4, i))
+            writer.write("[1481713137] PROCESS_HOST_CHECK_RESULT;host0;1;down\n")
+            writer.write("[1481713137] DISABLE_NOTIFICATIONS\n")  # not a check result, dropped
+            writer.close()
+            names = sorted(os.listdir(tmp_dir))
+            self.assertEqual(len(names), 6)
+            files = [n for n in names if not n.endswith('.ok')]
+            self.assertTrue(all(len(n) == 7 and n.startswith('c') and n + '.ok' in names for n in files))
+            results = []
+            for name in files:
+                with open(os.path.join(tmp_dir, name)) as f:
+                    content = f.read()
+                self.assertTrue(content.startswith("### Active Check Result File ###\nfile_time="))
+                results.extend(content.split("\n\n")[1:-1])
+            self.assertEqual(len(results), 1001)
+            self.assertTrue("### Nagios Service Check Result ###\nhost_name=host999\nservice_description=m999\n"
+                            "check_type=1\n" in "\n".join(results))
+            self.assertTrue("start_time=1481713137.0\nfinish_time=1481713137.0\nearly_timeout=0\nexited_ok=1\n"
+                            "return_code=3\noutput=summary 999\\ndetails\\n" in "\n".join(results))
+            self.assertTrue("### Nagios Host Check Result ###\nhost_name=host0\ncheck_type=1" in "\n".join(results))
+
+            # plugin submits passive results to the directory given by -C
+            shutil.rmtree(tmp_dir)
+            os.mkdir(tmp_dir)
+            app = nap.core.Plugin()
+
+            @app.metric(passive=True)
+            def test_m1(args, io):
+                io.set_status(nap.WARNING, "passive")
+
+            @app.metric()
+            def test_m2(args, io):
+                io.set_status(nap.OK, "active")
+
+            stream = StringIO()
+            self.assertEqual(app.execute(['-H', 'host1', '-C', tmp_dir], stdout=stream), nap.OK)
+            self.assertEqual(stream.getvalue(), "OK - active\n")
+            files = [n for n in os.listdir(tmp_dir) if not n.endswith('.ok')]
+            self.assertEqual(len(files), 1)
+            with open(os.path.join(tmp_dir, files[0])) as f:
+                self.assertTrue("host_name=host1\nservice_description=test_m1\n" in f.read())
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_check_result_flush_interval(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            writer = nap.core.CheckResultWriter(tmp_dir, flush_interval=0.2)
+            writer.write("[1481713137] PROCESS_SERVICE_CHECK_RESULT;localhost;m1;0;summary\n")
+            self.assertEqual(os.listdir(tmp_dir), [])  # buffered
+            # written without further results or close, while the plugin keeps running
+            for _ in range(50):
+                time.sleep(0.1)
+                if len(os.listdir(tmp_dir)) == 2:
+                    break
+            names = sorted(os.listdir(tmp_dir))
+            self.assertEqual(len(names), 2)
+            with open(os.path.join(tmp_dir, names[0])) as f:
+                self.assertTrue("host_name=localhost\nservice_description=m1\n" in f.read())
+            writer.close()
+            self.assertEqual(len(os.listdir(tmp_dir)), 2)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_dedup(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            results_dir = os.path.join(tmp_dir, 'checkresults')
+            os.mkdir(results_dir)
+            values = {'m1': 1, 'm2': 1}
+            app = nap.core.Plugin()
+
+            @app.metric(passive=True)
+            def test_m1(args, io):
+                io.add_perf_data("value", values['m1'])
+                io.set_status(nap.OK, "m1")
+
+            @app.metric(passive=True)
+            def test_m2(args, io):
+                print("details %f" % time.time())  # details are not compared
+                io.set_status(values['m2'], "m2")
+
+            @app.metric()
+            def test_m3(args, io):
+                io.set_status(nap.OK, "active")
+
+            def submitted():
+                services = []
+                for name in os.listdir(results_dir):
+                    if not name.endswith('.ok'):
+                        with open(os.path.join(results_dir, name)) as f:
+                            services.extend(re.findall(r"service_description=(\S+)", f.read()))
+                        os.unlink(os.path.join(results_dir, name))
+                return sorted(services)
+
+            def run():
+                app.execute(['-C', results_dir, '--dedup', '1', '--cache-dir', tmp_dir], stdout=StringIO())
+                return submitted()
+
+            self.assertEqual(run(), ['test_m1', 'test_m2'])
+            self.assertEqual(run(), [])
+            values['m1'] = 2
+            self.assertEqual(run(), ['test_m1'])
+            values['m2'] = nap.CRITICAL
+            self.assertEqual(run(), ['test_m2'])
+            # heartbeat
+            time.sleep(1.1)
+            self.assertEqual(run(), ['test_m1', 'test_m2'])
+            self.assertEqual(run(), [])
+
+            # failed submissions are not recorded, spooled ones are
+            values['m1'] = 3
+            values['m2'] = nap.WARNING
+            missing = os.path.join(tmp_dir, 'missing.cmd')
+            app.execute(['-C', missing, '--dedup', '3600', '--cache-dir', tmp_dir], stdout=StringIO())
+            self.assertEqual(run(), ['test_m1', 'test_m2'])
+            values['m1'] = 4
+            app.execute(['-C', missing, '--spool', os.path.join(tmp_dir, 'spool'), '--dedup', '3600',
+                         '--cache-dir', tmp_dir], stdout=StringIO())
+            self.assertEqual(run(), [])
+
+            # runs of other plugins sharing the index are merged
+            index = nap.cache.SubmissionIndex(tmp_dir, heartbeat=60)
+            other = nap.cache.SubmissionIndex(tmp_dir, heartbeat=60)
+            self.assertTrue(index.should_submit('host1', 'svc', 0, "OK - a | x=1;;;;\\ndetails"))
+            index.submitted('host1', 'svc', 0, "OK - a | x=1;;;;\\ndetails")
+            self.assertFalse(index.should_submit('host1', 'svc', 0, "OK - a | x=1;;;;\\nother details"))
+            self.assertTrue(other.should_submit('host2', 'svc', 0, "OK - a"))
+            other.submitted('host2', 'svc', 0, "OK - a")
+            index.close()
+            other.close()
+            index = nap.cache.SubmissionIndex(tmp_dir, heartbeat=60)
+            self.assertFalse(index.should_submit('host1', 'svc', 0, "OK - a | x=1;;;;"))
+            self.assertFalse(index.should_submit('host2', 'svc', 0, "OK - a"))
+            self.assertTrue(index.should_submit('host2', 'svc', 2, "CRITICAL - a"))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_structured_output(self):
+        import json
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            app = nap.core.Plugin()
+
+            @app.metric()
+            def test_m1(args, io):
+                print("details")
+                io.add_perf_data("cpu", 0.5, uom='%', warn=80, crit=90, vmin=0, vmax=100)
+                io.add_perf_data('queue "a"', 'U')
+                io.set_status(nap.WARNING, "cpu %s" % args.hostname)
+
+            @app.metric(passive=True)
+            def test_m2(args, io):
+                io.add_perf_data("value", float('nan'))
+                io.set_status(nap.OK, "ok")
+
+            stream = StringIO()
+            self.assertEqual(app.execute(['-o', 'ndjson', '-H', 'host1'], stdout=stream), nap.WARNING)
+            records = [json.loads(line) for line in stream.getvalue().splitlines()]
+            self.assertEqual(len(records), 2)
+            self.assertEqual(dict((k, v) for k, v in records[0].items() if k != 'timestamp'),
+                             {'host': 'host1', 'metric': 'test_m1', 'status': 1, 'state': 'WARNING',
+                              'summary': 'cpu host1', 'details': 'details\n',
+                              'perf_data': [{'label': 'cpu', 'value': 0.5, 'uom': '%', 'warn': 80, 'crit': 90,
+                                             'min': 0, 'max': 100}, {'label': 'queue "a"', 'value': 'U'}]})
+            self.assertEqual(records[1]['metric'], 'test_m2')
+
+            # records of fanned out metrics are written as they finish
+            stream = StringIO()
+            app.execute(['-o', 'ndjson', '-H', 'host1', '-H', 'host2', '-j', '2'], stdout=stream)
+            records = [json.loads(line) for line in stream.getvalue().splitlines()]
+            self.assertEqual(sorted((r['host'], r['metric']) for r in records),
+                             [('host1', 'test_m1'), ('host1', 'test_m2'), ('host2', 'fanout'),
+                              ('host2', 'test_m1'), ('host2', 'test_m2')])
+
+            textfile = os.path.join(tmp_dir, 'nap.prom')
+            stream = StringIO()
+            self.assertEqual(app.execute(['-o', 'openmetrics', '--textfile', textfile, '-H', 'host1'],
+                                         stdout=stream), nap.WARNING)
+            self.assertEqual(stream.getvalue(), "")
+            self.assertEqual(os.listdir(tmp_dir), ['nap.prom'])
+            with open(textfile) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(lines[:4], ['# TYPE nap_status gauge',
+                                         '# HELP nap_status Status of the metric (0 OK, 1 WARNING, 2 CRITICAL, '
+                                         '3 UNKNOWN)',
+                                         'nap_status{host="host1",metric="test_m1"} 1.0',
+                                         'nap_status{host="host1",metric="test_m2"} 0.0'])
+            self.assertTrue('nap_perf_data{host="host1",metric="test_m1",label="cpu",uom="%"} 0.5' in lines)
+            self.assertTrue('nap_perf_data{host="host1",metric="test_m2",label="value",uom=""} NaN' in lines)
+            self.assertTrue('nap_perf_data_critical{host="host1",metric="test_m1",label="cpu",uom="%"} 90.0' in lines)
+            self.assertFalse(any('queue' in line for line in lines))
+            self.assertEqual(lines[-1], '# EOF')
+            # without textfile, exposition is written to stdout
+            stream = StringIO()
+            app.execute(['-o', 'openmetrics', '-H', 'host1'], stdout=stream)
+            self.assertEqual(stream.getvalue().splitlines(), lines)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_deadline(self):
+        app = nap.core.Plugin()
+        tmp_dir = tempfile.mkdtemp()
+        pid_file = os.path.join(tmp_dir, 'pid')
+
+        @app.metric(timeout=1)
+        def test_m1(args, io):
+            nap.core.sub_process("sleep 30 & echo $! > %s; wait" % pid_file, shell=True, timeout=600)
+
+        @app.metric()
+        def test_m2(args, io):
+            time.sleep(5)
+
+        @app.metric()
+        def test_m3(args, io):
+            io.set_status(nap.OK, "not reached")
+
+        try:
+            start = time.time()
+            app.run(['--dry-run', '-t', '3'])
+            self.assertTrue(time.time() - start < 4)
+            self.assertEqual([e[1] for e in app.metric_results()], [nap.UNKNOWN, nap.UNKNOWN, nap.UNKNOWN])
+            self.assertEqual(app.metric_results()[2][2], "Metric didn't finish (timed out)")
+            with open(pid_file) as f:
+                pid = int(f.read())
+            for _ in range(20):  # wait for the killed child to be reaped
+                try:
+                    os.kill(pid, 0)
+                except OSError:
+                    break
+                time.sleep(0.1)
+            self.assertRaises(OSError, os.kill, pid, 0)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_deadline_parallel(self):
+        app = nap.core.Plugin()
+
+        @app.metric(timeout=1)
+        def test_m1(args, io):
+            time.sleep(3)
+
+        @app.metric()
+        def test_m2(args, io):
+            io.set_status(nap.OK, "m2 ok")
+
+        start = time.time()
+        app.run(['--dry-run', '-j', '2'])
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual(app.metric_results()[0][1:3], (nap.UNKNOWN, "Metric didn't finish (timed out)"))
+        self.assertEqual(app.metric_results()[1][1], nap.OK)
+
+    def test_spool(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fifo = os.path.join(tmp_dir, 'nagios.cmd')
+            cmd_pipe = nap.core.CommandPipe(fifo, spool=nap.spool.Spool(os.path.join(tmp_dir, 'spool')))
+            # pipe missing
+            cmd_pipe.write("[1] PROCESS_SERVICE_CHECK_RESULT;localhost;m1;0;first")
+            cmd_pipe.close()
+            # pipe without reader (Nagios restarting), doesn't block
+            os.mkfifo(fifo)
+            cmd_pipe.write("[2] PROCESS_SERVICE_CHECK_RESULT;localhost;m1;0;second")
+            cmd_pipe.close()
+            self.assertEqual(len(cmd_pipe.spool.segments()), 2)
+
+            received = []
+
+            def reader():
+                with open(fifo, 'rb') as f:
+                    received.append(f.read())
+
+            t = threading.Thread(target=reader)
+            t.start()
+            time.sleep(0.2)
+            cmd_pipe.write("[3] PROCESS_SERVICE_CHECK_RESULT;localhost;m1;0;third")
+            cmd_pipe.close()
+            t.join(10)
+            self.assertEqual([line.split(b' ')[0] for line in received[0].splitlines()], [b'[1]', b'[2]', b'[3]'])
+            self.assertEqual(cmd_pipe.spool.segments(), [])
+            # spool directories other users could have prepared are refused
+            os.symlink(os.path.join(tmp_dir, 'spool'), os.path.join(tmp_dir, 'link'))
+            self.assertRaises(OSError, nap.spool.Spool, os.path.join(tmp_dir, 'link'))
+            os.chmod(os.path.join(tmp_dir, 'spool'), 0o733)
+            self.assertRaises(OSError, nap.spool.Spool, os.path.join(tmp_dir, 'spool'))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_spool_segments(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fifo = os.path.join(tmp_dir, 'nagios.cmd')
+            spool_dir = os.path.join(tmp_dir, 'spool')
+            cmd_pipe = nap.core.CommandPipe(fifo, spool=nap.spool.Spool(spool_dir))
+            # flushes while the pipe is missing are appended to the same segment
+            for i in range(10):
+                cmd_pipe.write("[%d] PROCESS_SERVICE_CHECK_RESULT;localhost;m1;0;spooled" % i)
+                cmd_pipe.flush()
+            self.assertEqual(len(os.listdir(spool_dir)), 2)  # open segment and replay lock
+            received = []
+
+            def reader():
+                with open(fifo, 'rb') as f:
+                    received.append(f.read())
+
+            os.mkfifo(fifo)
+            t = threading.Thread(target=reader)
+            t.start()
+            time.sleep(0.2)
+            cmd_pipe.write("[10] PROCESS_SERVICE_CHECK_RESULT;localhost;m1;0;direct")
+            cmd_pipe.close()
+            t.join(10)
+            self.assertEqual([line.split(b' ')[0] for line in received[0].splitlines()],
+                             [('[%d]' % i).encode() for i in range(11)])
+            self.assertEqual(os.listdir(spool_dir), ['replay.lock'])
+
+            # command the pipe stops taking halfway is spooled after write_timeout
+            fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+            try:
+                cmd_pipe = nap.core.CommandPipe(fifo, spool=nap.spool.Spool(spool_dir), write_timeout=0.5)
+                start = time.time()
+                cmd_pipe.write("[11] PROCESS_SERVICE_CHECK_RESULT;localhost;m1;0;" + "x" * 1024 * 1024)
+                cmd_pipe.close()
+                self.assertTrue(time.time() - start < 5)
+                self.assertEqual(len(cmd_pipe.spool.segments()), 1)
+                with open(cmd_pipe.spool.segments()[0], 'rb') as f:
+                    self.assertTrue(f.read().startswith(b"[11] PROCESS_SERVICE_CHECK_RESULT"))
+            finally:
+                os.close(fd)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_result_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            app = nap.core.Plugin()
+            calls = []
+
+            @app.metric(cache_ttl=60)
+            def test_m1(args, io):
+                calls.append(args.hostname)
+                print("expensive | measurement")
+                io.add_perf_data("rtt", 12.5, uom="ms")
+                io.set_status(nap.WARNING, "measured")
+
+            outputs = []
+            for hostname in ['h1', 'h1', 'h2', 'h1']:
+                stream = StringIO()
+                ret_code = app.execute(['-H', hostname, '--cache-dir', tmp_dir, '--dry-run'], stdout=stream)
+                self.assertEqual(ret_code, nap.WARNING)
+                outputs.append(stream.getvalue().splitlines())
+            self.assertEqual(calls, ['h1', 'h2'])
+            self.assertEqual(outputs[0], outputs[1])
+            self.assertEqual(outputs[0][0], "WARNING - measured | rtt=12.5ms;;;; ")
+            self.assertEqual(outputs[0][1], "expensive \\u2758 measurement")
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_result_cache_plugins(self):
+        # plugins sharing the cache directory don't replay results of each other's metrics
+        tmp_dir = tempfile.mkdtemp()
+        argv0 = sys.argv[0]
+        try:
+            calls = []
+            outputs = []
+            for script in ['check_a', 'check_b', 'check_a']:
+                sys.argv[0] = os.path.join(tmp_dir, script)
+                app = nap.core.Plugin()
+
+                @app.metric(metric_name='test_m1', cache_ttl=60)
+                def test_m1(args, io, script=script):
+                    calls.append(script)
+                    io.set_status(nap.OK, "measured by %s" % script)
+
+                stream = StringIO()
+                app.execute(['--cache-dir', tmp_dir, '--dry-run'], stdout=stream)
+                outputs.append(stream.getvalue().splitlines()[0])
+            self.assertEqual(calls, ['check_a', 'check_b'])
+            self.assertEqual(outputs, ["OK - measured by check_a", "OK - measured by check_b",
+                                       "OK - measured by check_a"])
+            # entries are computed under their own lock files
+            self.assertEqual(len([n for n in os.listdir(tmp_dir) if n.startswith('lock.')]), 2)
+        finally:
+            sys.argv[0] = argv0
+            shutil.rmtree(tmp_dir)
+
+    def test_cache_directory(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            cache_dir = nap.cache.secure_directory(os.path.join(tmp_dir, 'cache'))
+            self.assertEqual(os.stat(cache_dir).st_mode & 0o777, 0o700)
+            nap.cache.FileCache(cache_dir).set('key', b'value')
+            # directories other users could have prepared are refused
+            os.symlink(cache_dir, os.path.join(tmp_dir, 'link'))
+            self.assertRaises(OSError, nap.cache.FileCache, os.path.join(tmp_dir, 'link'))
+            os.chmod(cache_dir, 0o777)
+            self.assertRaises(OSError, nap.cache.FileCache, cache_dir)
+            self.assertRaises(OSError, nap.cache.SubmissionIndex, cache_dir)
+            if os.access(os.path.expanduser('~'), os.W_OK):
+                self.assertFalse(nap.cache.default_directory().startswith(tempfile.gettempdir()))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_metric_stats(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            app = nap.core.Plugin()
+
+            @app.metric()
+            def test_m1(args, io):
+                nap.core.sub_process("/bin/sleep 0.2", shell=True, timeout=10)
+                sum(i * i for i in range(200000))
+                io.set_status(nap.OK, "m1 ok")
+
+            profile = os.path.join(tmp_dir, 'run.prof')
+            stream = StringIO()
+            app.execute(['--dry-run', '--runtime-perf-data', '--profile', profile], stdout=stream)
+            stats = app.metric_results()[0].stats
+            self.assertEqual(app.metric_results()[0].name, 'test_m1')
+            self.assertTrue(stats.wall >= 0.2)
+            self.assertTrue(0 < stats.cpu < stats.wall)
+            self.assertTrue(stats.children_cpu >= 0)
+            self.assertTrue(stats.max_rss > 0)
+            self.assertTrue(re.match(r"OK - m1 ok \| nap_runtime_test_m1=\d+\.\d{3}s;;;; \n", stream.getvalue()))
+
+            import pstats
+            self.assertTrue(any(f[2] == 'test_m1' for f in pstats.Stats(profile).stats.keys()))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_fanout(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fifo = os.path.join(tmp_dir, 'nagios.cmd')
+            os.mkfifo(fifo)
+            hosts_file = os.path.join(tmp_dir, 'hosts')
+            with open(hosts_file, 'w') as f:
+                f.write("# hosts\n" + "".join("host%d\n" % i for i in range(3, 20)))
+            app = nap.core.Plugin()
+
+            @app.metric()
+            def test_ping(args, io):
+                time.sleep(0.1)
+                io.set_status(nap.CRITICAL if args.hostname == 'host7' else nap.OK, "ping %s" % args.hostname)
+
+            @app.metric(depends_on=[test_ping])
+            def test_http(args, io):
+                io.set_status(nap.OK, "http %s" % args.hostname)
+
+            received = []
+
+            def reader():
+                with open(fifo, 'rb') as f:
+                    received.append(f.read())
+
+            t = threading.Thread(target=reader)
+            t.start()
+            stream = StringIO()
+            start = time.time()
+            ret_code = app.execute(['-H', 'host0', '-H', 'host1', '-H', 'host3', '--hosts-file', hosts_file,
+                                    '-C', fifo, '-j', '10'], stdout=stream)
+            t.join(10)
+            self.assertTrue(time.time() - start < 1)
+            self.assertEqual(ret_code, nap.CRITICAL)
+            lines = stream.getvalue().splitlines()
+            self.assertEqual(lines[0], "CRITICAL - Checked 19 hosts (38 metrics): 37 OK, 0 WARNING, 1 CRITICAL, "
+                                       "0 UNKNOWN | hosts=19;;;; ok=37;;;; warning=0;;;; critical=1;;;; unknown=0;;;; ")
+            self.assertEqual(lines[1:], ["CRITICAL host7 test_ping: ping host7"])
+            commands = received[0].decode().splitlines()
+            self.assertEqual(len(commands), 38)
+            self.assertTrue(any(";host19;test_http;0;OK - http host19" in c for c in commands))
+            self.assertEqual(app.metric_results()[-1][:2], ('fanout', nap.CRITICAL))
+
+            # empty hosts file doesn't fall back to checking localhost
+            with open(hosts_file, 'w') as f:
+                f.write("# no hosts\n")
+            stream = StringIO()
+            ret_code = app.execute(['--hosts-file', hosts_file, '-C', fifo], stdout=stream)
+            self.assertEqual(ret_code, nap.UNKNOWN)
+            self.assertTrue(stream.getvalue().startswith("UNKNOWN - No hosts to check | hosts=0;;;; "),
+                            stream.getvalue())
+            self.assertEqual([r.name for r in app.metric_results()], ['fanout'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_check_mk_cached(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            calls = os.path.join(tmp_dir, 'calls')
+            app = nap.core.Plugin()
+
+            @app.metric()
+            def test_m1(args, io):
+                with open(calls, 'a') as f:  # refresh may run in a forked child
+                    f.write('call\n')
+                io.add_perf_data("value", 1)
+                io.set_status(nap.WARNING, "measured")
+
+            def poll():
+                stream = StringIO()
+                ret_code = app.execute(['-o', 'check_mk', '--cached', '1', '--cache-dir', tmp_dir], stdout=stream)
+                self.assertEqual(ret_code, nap.WARNING)
+                match = re.match(r"cached\((\d+),1\) 1 test_m1 value=1;;;;\| measured\n$", stream.getvalue())
+                self.assertTrue(match, stream.getvalue())
+                return int(match.group(1))
+
+            def count():
+                with open(calls) as f:
+                    return len(f.readlines())
+
+            first = poll()
+            self.assertEqual(poll(), first)
+            self.assertEqual(count(), 1)
+            time.sleep(1.1)
+            # stale result is returned right away and refreshed in background
+            self.assertEqual(poll(), first)
+            for _ in range(50):
+                if count() == 2 and poll() != first:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(count(), 2)
+            self.assertTrue(poll() > first)
+
+            # failure to lock the refresh of results not cached yet is reported as such
+            def flock(f, operation):
+                raise IOError(errno.ENOLCK, "No locks available")
+
+            saved_flock = fcntl.flock
+            fcntl.flock = flock
+            try:
+                self.assertRaises(IOError, app.execute, ['-o', 'check_mk', '--cached', '1', '--cache-dir',
+                                                         os.path.join(tmp_dir, 'other')], stdout=StringIO())
+            finally:
+                fcntl.flock = saved_flock
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_check_mk_cached_plugins(self):
+        # plugins sharing the cache directory are served their own cached output
+        tmp_dir = tempfile.mkdtemp()
+        argv0 = sys.argv[0]
+        try:
+            outputs = []
+            for script, metric_name in [('check_a', 'test_a'), ('check_b', 'test_b'), ('check_a', 'test_a')]:
+                sys.argv[0] = os.path.join(tmp_dir, script)
+                app = nap.core.Plugin()
+
+                @app.metric(metric_name=metric_name)
+                def test_m1(args, io):
+                    io.add_perf_data("value", 1)
+                    io.set_status(nap.OK, "measured")
+
+                stream = StringIO()
+                app.execute(['-o', 'check_mk', '--cached', '60', '--cache-dir', tmp_dir], stdout=stream)
+                outputs.append(re.sub(r"cached\(\d+,", "cached(T,", stream.getvalue()))
+            self.assertEqual(outputs, ["cached(T,60) 0 test_a value=1;;;;| measured\n",
+                                       "cached(T,60) 0 test_b value=1;;;;| measured\n",
+                                       "cached(T,60) 0 test_a value=1;;;;| measured\n"])
+        finally:
+            sys.argv[0] = argv0
+            shutil.rmtree(tmp_dir)
+
+    def test_isolate(self):
+        app = nap.core.Plugin()
+
+        @app.metric(isolate=True)
+        def test_m1(args, io):
+            print("child %d" % os.getpid())
+            io.add_perf_data("value", 1)
+            io.set_status(nap.WARNING, "isolated")
+
+        @app.metric(isolate=True, max_memory=256 * 1024 * 1024)
+        def test_m2(args, io):
+            b'x' * (1024 * 1024 * 1024)
+
+        @app.metric(isolate=True, timeout=1)
+        def test_m3(args, io):
+            time.sleep(10)
+
+        stream = StringIO()
+        start = time.time()
+        app.execute(['--dry-run'], stdout=stream)
+        self.assertTrue(time.time() - start < 5)
+        results = dict((r.name, r) for r in app.metric_results())
+        self.assertEqual(results['test_m1'][:3], ('test_m1', nap.WARNING, 'isolated'))
+        output = stream.getvalue()
+        self.assertTrue("WARNING - isolated | value=1;;;; \nchild " in output)
+        self.assertFalse("child %d\n" % os.getpid() in output)
+        self.assertEqual(results['test_m2'].status, nap.UNKNOWN)
+        self.assertTrue('MemoryError' in output)
+        self.assertEqual(results['test_m3'].status, nap.UNKNOWN)
+
+    def test_isolate_passive(self):
+        # passive results submitted by isolated metrics are submitted (and deduplicated) by the parent
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            results_dir = os.path.join(tmp_dir, 'checkresults')
+            os.mkdir(results_dir)
+            app = nap.core.Plugin()
+
+            @app.metric(isolate=True)
+            def test_m1(args, io):
+                io.batch_passive_out('host1', 'test_sub', nap.WARNING, "sub result", "details\n")
+                io.set_status(nap.OK, "isolated")
+
+            def submitted():
+                services = []
+                for name in os.listdir(results_dir):
+                    if not name.endswith('.ok'):
+                        with open(os.path.join(results_dir, name)) as f:
+                            services.extend(re.findall(r"host_name=(\S+)\nservice_description=(\S+)", f.read()))
+                        os.unlink(os.path.join(results_dir, name))
+                return services
+
+            for expected in ([('host1', 'test_sub')], []):
+                stream = StringIO()
+                ret_code = app.execute(['-C', results_dir, '--dedup', '3600', '--cache-dir', tmp_dir], stdout=stream)
+                self.assertEqual(ret_code, nap.OK)
+                self.assertEqual(stream.getvalue(), "OK - isolated\n")
+                self.assertEqual(submitted(), expected)
+        finally:
+            shutil.rmtree(tmp_dir)
 
     def test_subprocess(self):
         rc, out = nap.core.sub_process("/bin/echo Yes", shell=True, timeout=20)
@@ -127,6 +908,33 @@ class TestNAP(unittest.TestCase):
         if SUBPROCESS_TIMEOUT:
             self.assertRaises(subprocess.TimeoutExpired, nap.core.sub_process, "/bin/sleep 10", shell=True, timeout=3)
 
+    def test_subprocess_stream(self):
+        lines = []
+        rc, out = nap.core.sub_process("seq 1 200000; exit 2", shell=True, timeout=20, max_output=1000,
+                                       output_head=100, callback=lines.append)
+        self.assertEqual(rc, 2)
+        self.assertEqual(len(lines), 200000)
+        self.assertEqual(lines[-1], b'200000\n')
+        self.assertTrue(out.startswith(b'1\n2\n'))
+        self.assertTrue(out.endswith(b'\n200000\n'))
+        self.assertTrue(b'bytes of output truncated' in out)
+        self.assertTrue(len(out) < 1100)
+
+        stream = nap.core.ProcessStream("echo a; printf 'b\\nc'; exit 3", shell=True)
+        self.assertEqual(list(stream), [b'a\n', b'b\n', b'c'])
+        self.assertEqual(stream.returncode, 3)
+
+        start = time.time()
+        stream = nap.core.ProcessStream("echo start; sleep 10", shell=True, timeout=1)
+        received = []
+        with self.assertRaises((nap.core.TimeoutError, subprocess.TimeoutExpired) if SUBPROCESS_TIMEOUT else
+                               nap.core.TimeoutError):
+            for line in stream:
+                received.append(line)
+        self.assertEqual(received, [b'start\n'])
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(stream.returncode, None)
+
 
 if __name__ == '__main__':
     unittest.main()
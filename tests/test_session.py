@@ -0,0 +1,64 @@
+import threading
+import time
+import unittest
+
+import nap.core
+import nap.session
+
+try:
+    import pexpect
+except ImportError:
+    pexpect = None
+
+
+class TestSession(unittest.TestCase):
+    def test_shell_session(self):
+        with nap.session.SessionPool(setup=['cd /tmp']) as pool:
+            self.assertEqual(pool.run("echo a; printf b"), (0, b'a\nb'))
+            self.assertEqual(pool.run(['printf', '%s', "it's; exit 1"]), (0, b"it's; exit 1"))
+            self.assertEqual(pool.run("pwd; false"), (1, b'/tmp\n'))
+            session = pool._idle[0]
+            # state persists in the session
+            pool.run("export NAP_SESSION=1")
+            self.assertEqual(pool.run("echo $NAP_SESSION"), (0, b'1\n'))
+            self.assertEqual(pool.run("seq 1 100000")[1].count(b'\n'), 100000)
+            # commands exiting the shell or timing out end the session, next command gets a new one
+            self.assertEqual(pool.run("exit 3"), (3, b''))
+            self.assertFalse(session.alive)
+            self.assertEqual(pool.run("echo $NAP_SESSION"), (0, b'\n'))
+            start = time.time()
+            # TimeoutExpired where subprocess supports timeouts (python 3, subprocess32)
+            subprocess = nap.core._import_subprocess()
+            with self.assertRaises(getattr(subprocess, 'TimeoutExpired', nap.core.TimeoutError)):
+                pool.run("sleep 10", timeout=1)
+            self.assertTrue(time.time() - start < 5)
+            self.assertEqual(pool.run("echo ok"), (0, b'ok\n'))
+
+    def test_pool(self):
+        pool = nap.session.SessionPool(size=2)
+        results = []
+
+        def run(i):
+            results.append(pool.run("echo %d" % i))
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+        self.assertEqual(sorted(results), sorted((0, ('%d\n' % i).encode()) for i in range(20)))
+        self.assertTrue(pool._count <= 2)
+        pool.close()
+        self.assertEqual(pool._count, 0)
+        self.assertEqual(nap.core.sub_process("echo session", mode='session'), (0, b'session\n'))
+
+    @unittest.skipIf(pexpect is None, "pexpect not available")
+    def test_pexpect_session(self):
+        with nap.session.SessionPool(factory=nap.session.PexpectSession, setup=['export NAP_SESSION=1']) as pool:
+            self.assertEqual(pool.run("echo $NAP_SESSION; printf x"), (0, b'1\nx'))
+            self.assertEqual(pool.run("cat; exit 4"), (4, b''))
+            self.assertEqual(pool.run("echo again"), (0, b'again\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
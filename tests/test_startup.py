@@ -0,0 +1,51 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules nap.core must not import until a run actually needs them
+LAZY_MODULES = ['argparse', 'asyncio', 'inspect', 'pexpect', 'queue', 'subprocess', 'subprocess32',
+                'nap.aio', 'nap.cache', 'nap.dq', 'nap.livestatus', 'nap.spool']
+if sys.version_info < (3, 7):  # no module __getattr__, nap.core imports subprocess eagerly
+    LAZY_MODULES.remove('subprocess')
+BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+# cumulative import time of nap.core may exceed the import_nap_core baseline (benchmarks/run.py --save)
+# by this factor, same as the default tolerance of benchmarks/run.py
+IMPORT_TOLERANCE = 2.0
+
+
+def _python(*args):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT
+    p = subprocess.Popen([sys.executable] + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         cwd=ROOT, env=env)
+    out, err = p.communicate()
+    return out.decode(), err.decode()
+
+
+class TestStartup(unittest.TestCase):
+    def test_lazy_imports(self):
+        out, _ = _python('-c', 'import sys, nap.core; print(" ".join(sorted(sys.modules)))')
+        self.assertEqual([m for m in LAZY_MODULES if m in out.split()], [])
+
+    @unittest.skipIf(sys.version_info < (3, 7), "-X importtime requires python 3.7")
+    def test_import_time(self):
+        with open(BASELINE) as f:
+            budget = json.load(f)['benchmarks']['import_nap_core']['value'] * IMPORT_TOLERANCE
+        timings = list()
+        for _ in range(3):
+            _, err = _python('-X', 'importtime', '-c', 'import nap.core')
+            for line in err.splitlines():
+                fields = [f.strip() for f in line.split('|')]
+                if len(fields) == 3 and fields[2] == 'nap.core':
+                    timings.append(int(fields[1]))
+        self.assertEqual(len(timings), 3)
+        self.assertTrue(min(timings) < budget,
+                        "import of nap.core took %d us (budget %d us)" % (min(timings), budget))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import io
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import nap
+import nap.core
+import nap.worker
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _plugin():
+    app = nap.core.Plugin()
+    app.add_argument("--state", type=int, default=0)
+
+    @app.metric()
+    def check(args, io):
+        print("details for %s" % args.hostname)
+        io.set_status(args.state, "state %d" % args.state)
+        io.add_perf_data("x", 1)
+
+    return app
+
+
+class TestWorker(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'worker.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _start(self, max_requests):
+        t = threading.Thread(target=nap.worker.serve, args=(_plugin(), self.path, max_requests))
+        t.daemon = True
+        t.start()
+        while not os.path.exists(self.path):
+            time.sleep(0.01)
+        return t
+
+    def test_execute(self):
+        handler = signal.getsignal(signal.SIGALRM)
+        stdout = sys.stdout
+        app = _plugin()
+        for state in range(4):
+            code, output = nap.worker.execute(app, ['-H', 'h%d' % state, '--state', str(state)])
+            self.assertEqual(code, state)
+            self.assertEqual(output, "%s - state %d | x=1;;;; \ndetails for h%d\n" %
+                             (nap.core.get_status(state), state, state))
+        code, output = nap.worker.execute(app, ['--unknown'])
+        self.assertEqual(code, 2)
+        self.assertTrue('unrecognized arguments' in output)
+        # process-wide state is left as it was
+        self.assertTrue(sys.stdout is stdout)
+        self.assertEqual(signal.getsignal(signal.SIGALRM), handler)
+
+    def test_serve(self):
+        t = self._start(max_requests=52)
+        start = time.time()
+        for i in range(50):
+            code, output = nap.worker.request(self.path, ['-H', 'host%d' % i, '--state', str(i % 3)])
+            self.assertEqual(code, i % 3)
+            self.assertTrue(output.endswith("details for host%d\n" % i))
+        self.assertTrue(time.time() - start < 10)
+        code, output = nap.worker.request(self.path, ['--help'])
+        self.assertEqual(code, 0)
+        self.assertTrue('--state' in output)
+        # client shim
+        env = dict(os.environ)
+        env['PYTHONPATH'] = ROOT
+        p = subprocess.Popen([sys.executable, '-m', 'nap.worker', self.path, '-H', 'shim', '--state', '1'],
+                             stdout=subprocess.PIPE, cwd=ROOT, env=env)
+        out, _ = p.communicate()
+        self.assertEqual(p.returncode, 1)
+        self.assertEqual(out.decode(), "WARNING - state 1 | x=1;;;; \ndetails for shim\n")
+        t.join(10)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(nap.worker.main([self.path]), nap.UNKNOWN)
+
+    def test_socket_path(self):
+        # socket left over by a worker that is gone is replaced
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.path)
+        stale.close()
+        t = threading.Thread(target=nap.worker.serve, args=(_plugin(), self.path, 1))
+        t.daemon = True
+        t.start()
+        while True:
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                break
+            except socket.error:
+                time.sleep(0.01)
+            finally:
+                probe.close()
+        # live worker's socket and other files are left alone
+        self.assertRaises(OSError, nap.worker.serve, _plugin(), self.path, 1)
+        self.assertEqual(nap.worker.request(self.path, ['--state', '1'])[0], 1)
+        t.join(10)
+        other = os.path.join(self.tmp_dir, 'other')
+        with open(other, 'w') as f:
+            f.write('keep')
+        self.assertRaises(OSError, nap.worker.serve, _plugin(), other, 1)
+        with open(other) as f:
+            self.assertEqual(f.read(), 'keep')
+
+    def test_serve_stream(self):
+        requests = [['-H', 'a'], 'invalid', ['-H', 'b', '--state', '2']]
+        rfile = io.BytesIO(b''.join((json.dumps(r) + '\n').encode() for r in requests))
+        wfile = io.BytesIO()
+        self.assertEqual(nap.worker.serve_stream(_plugin(), rfile, wfile), 3)
+        wfile.seek(0)
+        codes = list()
+        while True:
+            header = wfile.readline().split()
+            if not header:
+                break
+            codes.append(int(header[0]))
+            wfile.read(int(header[1]))
+        self.assertEqual(codes, [0, 3, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()